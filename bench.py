@@ -0,0 +1,357 @@
+"""
+Offline benchmarks for reposti. Discord is replaced by a fake guild whose channel history yields synthetic messages,
+and the CDN by a local HTTP server with a generated image corpus.
+
+    python bench.py --messages 2000 --sizes 1000,10000,100000 --output bench.json
+
+Results are printed (or written to --output) as JSON, so runs can be compared to catch regressions.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+from os import environ, path
+
+SNOWFLAKE_START = 800000000000000000
+
+
+class FakeObject:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeGuild:
+    def __init__(self, name, id):
+        self.name = name
+        self.id = id
+        self.owner_id = 1
+        self.channels = []
+
+    @property
+    def text_channels(self):
+        return self.channels
+
+    def get_channel(self, id):
+        return next((c for c in self.channels if c.id == id), None)
+
+
+class FakeChannel:
+    """
+    A text channel with a fixed history. history() takes the same arguments as discord.TextChannel.history.
+    """
+
+    def __init__(self, guild, id, name, messages=()):
+        self.guild = guild
+        self.id = id
+        self.name = name
+        self.messages = list(messages)  # oldest first
+        guild.channels.append(self)
+
+    async def history(self, limit=100, before=None, after=None, oldest_first=None):
+        messages = self.messages
+        if before is not None:
+            messages = [m for m in messages if m.id < before.id]
+        if after is not None:
+            messages = [m for m in messages if m.id > after.id]
+        if not oldest_first:
+            messages = messages[::-1]
+        for m in messages[:limit]:
+            await asyncio.sleep(0)
+            yield m
+
+    async def fetch_message(self, id):
+        return next(m for m in self.messages if m.id == int(id))
+
+
+def fake_message(channel, id, image_urls, embed_urls):
+    import discord
+    embeds = []
+    for url in embed_urls:
+        embed = discord.Embed(type="image", url=url)
+        embed.set_thumbnail(url=url)
+        embeds.append(embed)
+    attachments = [FakeObject(id=id + i, url=url, filename=url.rsplit("/", 1)[-1])
+                   for i, url in enumerate(image_urls)]
+    return FakeObject(id=id, channel=channel, guild=channel.guild, attachments=attachments, embeds=embeds,
+                      content="", author=FakeObject(id=2),
+                      jump_url=f"https://discord.com/channels/{channel.guild.id}/{channel.id}/{id}")
+
+
+def make_corpus(n, seed=0):
+    """
+    Returns n distinct JPEG and PNG images of random colour blocks, as bytes.
+    """
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    corpus = []
+    for i in range(n):
+        blocks = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+        img = Image.fromarray(blocks).resize((800, 600), Image.BILINEAR)
+        buffer = BytesIO()
+        img.save(buffer, "PNG" if i % 4 == 0 else "JPEG")
+        corpus.append(buffer.getvalue())
+    return corpus
+
+
+async def serve_corpus(corpus):
+    """
+    Serves the corpus at http://127.0.0.1:<port>/<i>. Query strings are ignored, so that each message can use its
+    own URL for the same image. Returns the runner and the base URL.
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=corpus[int(request.match_info["i"]) % len(corpus)], content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/{i}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def fill_channel(channel, base_url, n_messages, n_images, rng, first_id):
+    """
+    Adds messages with 0-2 attachments and sometimes an image embed, all picked from the corpus.
+    Returns the number of image URLs.
+    """
+    images = 0
+    for i in range(n_messages):
+        message_id = first_id + i * 1000
+        attachments = [f"{base_url}/{rng.randrange(n_images)}?m={message_id}-{k}"
+                       for k in range(rng.choice((0, 0, 1, 1, 1, 2)))]
+        embeds = [f"{base_url}/{rng.randrange(n_images)}?e={message_id}"] if rng.random() < 0.2 else []
+        channel.messages.append(fake_message(
+            channel, message_id, attachments, embeds))
+        images += len(attachments) + len(embeds)
+    return images
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {"p50_ms": 1000 * statistics.median(samples),
+            "p99_ms": 1000 * samples[min(len(samples) - 1, int(len(samples) * 0.99))]}
+
+
+async def bench_scan(bot, data, guild, base_url, args, rng):
+    channels = [FakeChannel(guild, 100 + c, f"bench-{c}")
+                for c in range(args.channels)]
+    images = sum(fill_channel(channel, base_url, args.messages // args.channels, args.images, rng,
+                              SNOWFLAKE_START + c * 10 ** 9) for c, channel in enumerate(channels))
+    start = time.perf_counter()
+    results = await asyncio.gather(*[bot.scan_channel(c, data, {"limit": None}) for c in channels])
+    seconds = time.perf_counter() - start
+    messages = sum(r[0] + r[1] for r in results)
+    return {"messages": messages, "images": images, "channels": len(channels), "seconds": seconds,
+            "messages_per_s": messages / seconds, "images_per_s": images / seconds,
+            "errors": sum(r[3] for r in results)}
+
+
+async def bench_check(bot, data, guild, base_url, args, rng):
+    from hashindex import HASH_BITS
+    channel = FakeChannel(guild, 99, "bench-check")
+    out = []
+    stored = 0
+    for size in args.sizes:
+        hashes = {f"{rng.getrandbits(HASH_BITS):064x}": [(channel.id, SNOWFLAKE_START + i)]
+                  for i in range(size - stored)}
+        bot.add_hash_data(data, guild, hashes)
+        stored = size
+        index = bot.get_hash_index(data, guild)
+        timings = []
+        lookups = []
+        for i in range(args.checks):
+            message = fake_message(channel, SNOWFLAKE_START * 2 + size + i,
+                                   [f"{base_url}/{rng.randrange(args.images)}?c={size}-{i}"], [])
+            start = time.perf_counter()
+            await bot.check_message(data, message, bot.SAME_DIFF)
+            timings.append(time.perf_counter() - start)
+            query = [f"{rng.getrandbits(HASH_BITS):064x}"]
+            start = time.perf_counter()
+            index.query_many(query, bot.SAME_DIFF)
+            lookups.append(time.perf_counter() - start)
+        lookup = percentiles(lookups)
+        out.append({"stored_hashes": len(index), **percentiles(timings),
+                    "lookup_p50_ms": lookup["p50_ms"], "lookup_p99_ms": lookup["p99_ms"]})
+    return out
+
+
+def perturb(img_data, rng):
+    """
+    Returns a repost-like copy of an image: rescaled, slightly cropped, brightened and recompressed as JPEG.
+    """
+    from PIL import Image, ImageEnhance
+    img = Image.open(BytesIO(img_data)).convert("RGB")
+    scale = rng.uniform(0.4, 1.2)
+    crop = rng.randrange(0, 12)
+    img = img.resize((int(img.width * scale), int(img.height * scale)))
+    img = img.crop((crop, crop, img.width - crop, img.height - crop))
+    img = ImageEnhance.Brightness(img).enhance(rng.uniform(0.85, 1.15))
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=rng.randrange(30, 90))
+    return buffer.getvalue()
+
+
+def bench_cascade(bot, corpus, args, rng):
+    """
+    Matches perturbed copies of the corpus against the hashes of the originals, with the full index and with the
+    cascade at each prefilter distance. Recall is the share of the full index's matches that the cascade finds,
+    precision the share of the prefilter's candidates that are matches.
+    """
+    import hashing
+    import metrics
+    from hashindex import CascadeIndex, HashIndex
+    stored = [hashing.hash_image(img_data) for img_data in corpus]
+    queries = [hashing.hash_image(perturb(img_data, rng)) for img_data in corpus]
+    full = HashIndex(stored)
+    timings = []
+    expected = []
+    for h in queries:
+        start = time.perf_counter()
+        expected.append(full.query(h, bot.SAME_DIFF))
+        timings.append(time.perf_counter() - start)
+    out = {"queries": len(queries), "true_matches": sum(map(len, expected)), "full": percentiles(timings),
+           "prefilter": []}
+    for prefilter_diff in args.prefilter_diffs:
+        cascade = CascadeIndex(stored, prefilter_diff=prefilter_diff)
+        before = {k: metrics.count(k) for k in ("cascade_candidates_total", "cascade_matches_total")}
+        timings = []
+        found = 0
+        for h, true_matches in zip(queries, expected):
+            start = time.perf_counter()
+            matches = cascade.query(h, bot.SAME_DIFF)
+            timings.append(time.perf_counter() - start)
+            found += len({m for m, _ in matches} & {m for m, _ in true_matches})
+        candidates, matched = (metrics.count(k) - n for k, n in before.items())
+        out["prefilter"].append({"prefilter_diff": prefilter_diff,
+                                 "recall": found / max(out["true_matches"], 1),
+                                 "precision": matched / max(candidates, 1),
+                                 "candidates_per_query": candidates / len(queries), **percentiles(timings)})
+    return out
+
+
+def bench_persistence(directory, args, rng):
+    """
+    Times the storage calls made by add_hash_data, add_scanned_range and set_guild_data for every engine,
+    against a guild that already has args.persist_size hashes.
+    """
+    from ranges import IntervalSet
+    from storage import JSONStorage, SQLiteStorage
+    out = {}
+    for name, engine in (("sqlite", SQLiteStorage(path.join(directory, "persist.sqlite3"), directory)),
+                         ("json", JSONStorage(directory))):
+        guild_name = f"Persist{name}_1"
+        guild_data = engine.load_guild(guild_name)
+        guild_data["hashes"] = {f"{rng.getrandbits(256):064x}": [[1, i]]
+                                for i in range(args.persist_size)}
+        engine.set_value(guild_name, "hashes", guild_data["hashes"])
+        timings = {"add_postings": [], "set_scanned_ranges": [], "set_value": []}
+        ranges = IntervalSet()
+        for i in range(args.writes):
+            new = {f"{rng.getrandbits(256):064x}": [[1, args.persist_size + i]]}
+            guild_data["hashes"].update(new)
+            start = time.perf_counter()
+            engine.add_postings(guild_name, new)
+            timings["add_postings"].append(time.perf_counter() - start)
+            ranges.add(i * 10, i * 10 + 5)
+            guild_data.setdefault("scanned_ranges", {})["1"] = ranges
+            start = time.perf_counter()
+            engine.set_scanned_ranges(guild_name, 1, ranges)
+            timings["set_scanned_ranges"].append(time.perf_counter() - start)
+            guild_data["enabled"] = bool(i % 2)
+            start = time.perf_counter()
+            engine.set_value(guild_name, "enabled", guild_data["enabled"])
+            timings["set_value"].append(time.perf_counter() - start)
+        out[name] = {k: percentiles(v) for k, v in timings.items()}
+    return out
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory(prefix="reposti-bench-") as directory:
+        return await _run(args, directory)
+
+
+async def _run(args, directory):
+    # point every on-disk store at the temporary directory before the bot modules read their settings
+    environ["REPOSTI_DB"] = path.join(directory, "reposti.sqlite3")
+    environ["REPOSTI_HASH_CACHE"] = ""
+    environ.setdefault("REPOSTI_STORAGE", "sqlite")
+    import bot
+    import fetch
+    import hashing
+    import metrics
+    from storage import get_storage
+
+    rng = random.Random(args.seed)
+    corpus = make_corpus(args.images, args.seed)
+    runner, base_url = await serve_corpus(corpus)
+    guild = FakeGuild("Bench", 1)
+    guild_name, _ = bot.unique_guild_data(guild)
+    data = {guild_name: get_storage().load_guild(guild_name)}
+    try:
+        results = {
+            "scan": await bench_scan(bot, data, guild, base_url, args, rng),
+            "check_message": await bench_check(bot, data, guild, base_url, args, rng),
+            "persistence": bench_persistence(directory, args, rng),
+            "cascade": bench_cascade(bot, corpus, args, rng),
+            "hash_cache": {dict(labels)["result"]: n for (name, labels), n in metrics.counters.items()
+                           if name == "hash_cache_lookups_total"},
+        }
+    finally:
+        await fetch.close_session()
+        hashing.shutdown()
+        await runner.cleanup()
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results["peak_rss_children_kb"] = resource.getrusage(
+        resource.RUSAGE_CHILDREN).ru_maxrss
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=2000,
+                        help="messages to scan, split over the channels")
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--images", type=int, default=200,
+                        help="distinct images in the corpus")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="stored hash counts to measure check_message at")
+    parser.add_argument("--checks", type=int, default=200,
+                        help="check_message calls per size")
+    parser.add_argument("--persist-size", type=int, default=20000,
+                        help="hashes already stored when timing writes")
+    parser.add_argument("--writes", type=int, default=50)
+    parser.add_argument("--prefilter-diffs", default="3,5,7,9,11",
+                        help="CascadeIndex prefilter distances to measure recall and precision at")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args(argv)
+    args.sizes = sorted(int(s) for s in args.sizes.split(","))
+    args.prefilter_diffs = [int(s) for s in args.prefilter_diffs.split(",")]
+
+    started = time.time()
+    results = {"started": started, "python": sys.version.split()[0],
+               "config": {k: v for k, v in vars(args).items() if k != "output"}}
+    with contextlib.redirect_stdout(sys.stderr):  # keep the bot's progress messages out of the results
+        results.update(asyncio.run(run(args)))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
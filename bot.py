@@ -1,14 +1,56 @@
+import asyncio
+import aiohttp
 import discord
-import imagehash
-import requests
-import json
+import fetch
+import time
+import hashing
+import metrics
+import multiprocessing
+import profiler
+import scheduler
+from cache import CachedFailure, digest, get_hash_cache
+from concurrent.futures.process import BrokenProcessPool
+from hashindex import CascadeIndex, HashIndex, hash_distance
+from hashstore import HashStore
+from ranges import IntervalSet, split_ranges
+from storage import get_storage
 # from textdistance import hamming
-from PIL import Image, UnidentifiedImageError
-from os import environ, path
+from collections import OrderedDict, deque
+from datetime import datetime
 from io import BytesIO
+from os import cpu_count, environ, path
 
 SAME_DIFF = 20
-HASH_SIZE = 16
+SCAN_WORKERS = int(environ.get("REPOSTI_SCAN_WORKERS", 8))  # download and hash workers per channel
+SCAN_QUEUE_SIZE = 4 * SCAN_WORKERS
+SCAN_CHANNELS = int(environ.get("REPOSTI_SCAN_CHANNELS", 4))  # channels scanned at once
+SCAN_CURSORS = int(environ.get("REPOSTI_SCAN_CURSORS", 4))  # history cursors reading a whole channel at once
+SCAN_SEGMENTS = 4 * SCAN_CURSORS  # segments a whole channel is split into, so that busy ones can be shared out
+# shortest segment in message IDs, so that the few new messages of a channel scanned before are read in one go
+SCAN_SEGMENT_MIN = int(float(environ.get("REPOSTI_SCAN_SEGMENT_HOURS", 24)) * 3600 * 1000) << 22
+SCAN_MESSAGES = int(environ.get("REPOSTI_SCAN_MESSAGES", 32))  # messages being hashed at once, across all scans
+CHECKPOINT_MESSAGES = int(environ.get("REPOSTI_CHECKPOINT_MESSAGES", 500))
+CHECKPOINT_SECONDS = float(environ.get("REPOSTI_CHECKPOINT_SECONDS", 60))
+MAX_PROFILE_SECONDS = 600
+GUILD_CACHE_BYTES = int(environ.get("REPOSTI_GUILD_CACHE_MB", 1024)) * 2 ** 20
+EVICT_SECONDS = 10  # how often growing guilds are checked against GUILD_CACHE_BYTES at most
+# match through a 64 bit prefilter first (see CascadeIndex) when set to the largest prefilter distance to pass on
+CASCADE_DIFF = int(environ.get("REPOSTI_CASCADE_DIFF", -1))
+# processes to run, each connected to Discord as its own shard and owning that shard's guilds
+SHARD_COUNT = int(environ.get("REPOSTI_SHARDS", 1))
+# the shards to run on this host, when the shards are spread over several hosts sharing the storage
+SHARD_IDS = [int(i) for i in environ.get("REPOSTI_SHARD_IDS", "").split(",") if i] or list(range(SHARD_COUNT))
+CASCADE_AUDIT = float(environ.get("REPOSTI_CASCADE_AUDIT", 0.01))  # share of cascade queries checked for recall
+INDEX_ENTRY_BYTES = 400  # the HashIndex entries of a hash, roughly
+# seconds that an image which failed is not downloaded again for, by kind of failure: files that are not images or
+# are too large, 4xx responses and images too slow to hash, and timeouts, connection errors and server errors
+FAILURE_TTLS = {
+    "bad_image": float(environ.get("REPOSTI_FAILURE_TTL_BAD_IMAGE", 30 * 86400)),
+    "refused": float(environ.get("REPOSTI_FAILURE_TTL_REFUSED", 86400)),
+    "transient": float(environ.get("REPOSTI_FAILURE_TTL_TRANSIENT", 600)),
+}
+# everything hashing a single image can fail with
+IMAGE_ERRORS = (*hashing.HASH_ERRORS, aiohttp.ClientError, asyncio.TimeoutError, CachedFailure)
 
 default_strings = {
     "scan": "reposti scan",
@@ -22,151 +64,485 @@ default_strings = {
     "hash": "reposti hash",
     "hashdiff": "reposti diff",
     "diff": "reposti diff",
+    "stats": "reposti stats",
+    "profile": "reposti profile",
     "repost_found": "General reposti"
 
 }
 
+guild_settings = {}  # guild ID -> GuildSettings
+hash_indexes = {}  # guild name -> HashIndex, built from the guild's hashes on first use
+channel_slots = None
+message_slots = None
+active_scans = {}  # channel ID -> Scan
+metrics.gauge("scans_active", lambda: len(active_scans))
+metrics.gauge("cascade_prefilter_diff", lambda: CASCADE_DIFF)
+metrics.gauge("scan_queue_depth", lambda: sum(
+    s.messages.qsize() for s in active_scans.values() if s.messages))
+metrics.gauge("scan_results_depth", lambda: sum(
+    s.results.qsize() for s in active_scans.values() if s.results))
+
 
 def hash_diff(h1, h2):
     """
     ImageHash difference is computed by finding the Hamming distance between the binary arrays.
     We only store the hash.
     """
-    return imagehash.hex_to_hash(h1) - imagehash.hex_to_hash(h2)
+    return hash_distance(h1, h2)
+
+
+async def hash_url(key, url):
+    """
+    Returns the hash of the image at url, from the hash cache if this key or the downloaded bytes were hashed before.
+    """
+    return await hash_cached(key, fetch.download, url)
+
+
+def failure_kind(e):
+    """
+    Returns the kind of failure e is, one of FAILURE_TTLS. Failures that are not about the image itself are not
+    remembered: "unavailable" for an open circuit or a broken hashing pool, which pass, and None for the rest, like
+    a file that could not be read.
+    """
+    if isinstance(e, CachedFailure):
+        return e.kind
+    if isinstance(e, (fetch.CircuitOpen, BrokenProcessPool)):
+        return "unavailable"
+    if isinstance(e, aiohttp.ClientResponseError):
+        return "refused" if 400 <= e.status < 500 and e.status != 429 else "transient"
+    if isinstance(e, fetch.DownloadTooLarge):
+        return "bad_image"
+    if isinstance(e, hashing.OutOfTime):
+        return "refused"
+    if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+        return "transient"
+    if isinstance(e, OSError) and e.errno is not None:
+        return None  # reading the file failed, decoding errors have no errno
+    if isinstance(e, hashing.HASH_ERRORS):
+        return "bad_image"
+    return None
+
+
+def is_transient(e):
+    """
+    Returns whether an image that failed with e is likely to work on a later try, so that the message it is in should
+    not be recorded as scanned.
+    """
+    return failure_kind(e) in ("transient", "unavailable")
 
 
-def image_hash_from_message(message):
+async def hash_cached(key, load, *args):
+    """
+    Returns the hash of the image bytes returned by `await load(*args)`, unless this key or those bytes were hashed
+    before. A key of None only caches by the bytes. Keys that failed recently raise CachedFailure instead of being
+    loaded again, see failure_kind.
+    """
+    hash_cache = get_hash_cache()
+    if key is not None:
+        if (h := hash_cache.get_key(key)) is not None:
+            return h
+        if (failure := hash_cache.get_failure(key)) is not None:
+            raise CachedFailure(*failure)
+    try:
+        img_data = await load(*args)
+        img_digest = digest(img_data)
+        if (h := hash_cache.get_digest(img_digest)) is None:
+            h = await hashing.hash_bytes(img_data)
+    except IMAGE_ERRORS as e:
+        kind = failure_kind(e)
+        if key is not None and kind in FAILURE_TTLS:
+            hash_cache.put_failure(key, f"{type(e).__name__}: {e}", kind, FAILURE_TTLS[kind])
+        raise
+    hash_cache.put(key, img_digest, h)
+    return h
+
+
+async def image_hash_from_message(message):
     """
     Returns list of hashes(str) of images in message. Embeds with no images are None, embeds with errors are 0.
+    "transient" counts the errors that may not happen again on a later try, see is_transient.
     """
+    with metrics.timer("image_hash_from_message_seconds"):
+        return await _image_hash_from_message(message)
+
+
+async def _image_hash_from_message(message):
     # if len(message.embeds) == 0:
     #     return False
     # print("Has embed:", m.jump_url)
-    out = {"hashes": [], "errors": 0, "unhashables": 0}
-    urls = []
+    out = {"hashes": [], "errors": 0, "transient": 0, "unhashables": 0}
+    urls = []  # (cache key, url)
     for embed in message.embeds:
         if embed.thumbnail.url is not discord.Embed.Empty:
-            urls.append(embed.thumbnail.url)
+            urls.append((embed.thumbnail.url, embed.thumbnail.url))
         elif embed.image.url is not discord.Embed.Empty:
-            urls.append(embed.image.url)
+            urls.append((embed.image.url, embed.image.url))
         elif embed.url is not discord.Embed.Empty and embed.type == 'image':
-            urls.append(embed.url)
+            urls.append((embed.url, embed.url))
         else:
             out["unhashables"] += 1
     for attachment in message.attachments:
-        urls.append(attachment.url)
-    for url in urls:
+        # attachment IDs stay the same when Discord changes the CDN URL
+        urls.append((f"attachment:{attachment.id}", attachment.url))
+    # every image is downloaded and hashed concurrently
+    results = await asyncio.gather(*[hash_url(key, url) for key, url in urls], return_exceptions=True)
+    for (_, url), result in zip(urls, results):
         # print(url)
-        try:
-            img_data = requests.get(url).content
-            img = Image.open(BytesIO(img_data))
-            out["hashes"].append(
-                str(imagehash.whash(img, hash_size=HASH_SIZE)))
-        except UnidentifiedImageError as e:
+        if isinstance(result, IMAGE_ERRORS):
             out["errors"] += 1
-            print(e, url)
+            out["transient"] += is_transient(result)
+            print(repr(result), url)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            out["hashes"].append(result)
+    metrics.inc("images_total", len(urls))
+    metrics.inc("image_errors_total", out["errors"])
     return out
 
 
-def num_in_ranges(ranges, num: int):
+class ScanCancelled(Exception):
+    pass
+
+
+class Scan:
     """
-    Returns whether a number is in a list of sorted ranges.
+    Progress of a channel scan that is queued or running, see active_scans.
     """
-    if len(ranges) > 1:
-        if num < ranges[len(ranges) // 2][0]:
-            return num_in_ranges(ranges[:len(ranges) // 2], num)
-        else:
-            return num_in_ranges(ranges[len(ranges) // 2:], num)
-    elif len(ranges) == 1:
-        return num >= ranges[0][0] and num <= ranges[0][1]
-    else:
-        return False
-
-
-def add_range(ranges, new_range: tuple):
-    """
-    Adds a range to a list of ranges
-    """
-    min_i = None
-    max_i = None
-    # extend a range to the union of the new range and the nearest overlap
-    for i, r in enumerate(ranges):
-        if r[0] <= new_range[0] and new_range[0] <= r[1] or new_range[0] <= r[0] and r[0] <= new_range[1] and min_i is None:
-            r[0] = min(r[0], new_range[0])
-            min_i = i
-        if r[0] <= new_range[1] and new_range[1] <= r[1] or new_range[0] <= r[1] and r[1] <= new_range[1]:
-            ranges[min_i][1] = max(r[1], new_range[1])
-            max_i = i
-    # if there is no overlap, insert the new range
-    if min_i is None and max_i is None:
-        for i, r in enumerate(ranges):
-            if new_range[1] < r[0]:
-                ranges.insert(i, list(new_range))
-                break
-        else:
-            ranges.append(list(new_range))
-    else:
-        # pop all ranges between the min and max of the new range
-        for i in range(min_i + 1, max_i + 1):
-            ranges.pop(min_i + 1)
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.task = asyncio.current_task()
+        self.started = time.monotonic()
+        self.read = 0
+        self.scanned = 0
+        self.skipped = 0
+        self.errors = 0
+        self.unfinished = 0  # posts with images that failed for now, which are not recorded as scanned
+        self.cancelled = False  # by a user, as opposed to the bot shutting down
+        self.messages = None  # queues of the pipeline, once it runs
+        self.results = None
+
+    def __str__(self):
+        minutes = (time.monotonic() - self.started) / 60
+        return f"#{self.channel.name}: read {self.read} posts, scanned {self.scanned}, skipped {self.skipped}, {self.errors} errors, running for {minutes:.0f} min"
+
+    def cancel(self):
+        self.cancelled = True
+        self.task.cancel()
+
+
+def scan_budget():
+    """
+    Returns the semaphores shared by every scan: one for channels being scanned, one for messages being hashed.
+    """
+    global channel_slots, message_slots
+    if channel_slots is None:
+        channel_slots = asyncio.Semaphore(SCAN_CHANNELS)
+        message_slots = asyncio.Semaphore(SCAN_MESSAGES)
+    return channel_slots, message_slots
+
+
+class ScanCursor:
+    """
+    One channel.history() iterator of a scan. Its messages are finished out of order, so the range it has covered
+    only extends over the messages that are all done. A cursor either reads a channel newest first from start
+    (the newest message of an earlier run, if any), or reads the segment [start, end] oldest first.
+    """
+
+    def __init__(self, history_args, start=None, end=None):
+        self.history_args = history_args
+        self.start = start
+        self.end = end
+        self.read = 0
+        self.first_id = None  # first message read
+        self.pending = {}  # position in history -> message ID, for messages that are not done yet
+        self.done = set()  # positions of messages that are done, but after an unfinished one
+        self.watermark = -1  # position of the last message before which everything is done
+        self.watermark_id = None
+        self.exhausted = False
+
+    @classmethod
+    def segment(cls, start, end):
+        return cls({"limit": None, "after": discord.Object(start - 1), "before": discord.Object(end + 1),
+                    "oldest_first": True}, start, end)
+
+    def finish(self, position):
+        self.done.add(position)
+        while self.watermark + 1 in self.done:
+            self.watermark += 1
+            self.done.remove(self.watermark)
+            self.watermark_id = self.pending.pop(self.watermark)
+
+    @property
+    def complete(self):
+        return self.exhausted and not self.pending
+
+    def covered(self):
+        """
+        Returns the range of message IDs that are all scanned, or None.
+        """
+        if self.end is not None and self.complete:
+            return self.start, self.end
+        if self.watermark_id is None:
+            return None
+        return self.start or self.first_id, self.watermark_id
+
+    def remaining(self):
+        """
+        Returns the part of a segment that is not covered yet.
+        """
+        return [self.start if self.watermark_id is None else self.watermark_id + 1, self.end]
+
+
+def scan_segments(channel, before, scanned_ranges):
+    """
+    Splits the snowflake IDs that messages of channel can have, from the channel's creation until before (or now),
+    into SCAN_SEGMENTS segments of at least SCAN_SEGMENT_MIN IDs, leaving out scanned_ranges. Returns them newest first.
+    """
+    end = getattr(before, "id", before) - 1 if before else discord.utils.time_snowflake(
+        datetime.utcnow())
+    return split_ranges(scanned_ranges.gaps(channel.id, end), SCAN_SEGMENTS, SCAN_SEGMENT_MIN)[::-1]
 
 
-async def scan_channel(channel, data, history_args, until_message=None, force_rescan=False):
+async def scan_channel(channel, data, history_args, until_message=None, force_rescan=False, range_start=None,
+                       reply_channel=None, segments=None):
+    """
+    Scans a channel's history as a pipeline: the history is read into a bounded queue, SCAN_WORKERS workers
+    download and hash its messages, and a single aggregator merges their hashes.
+    A whole channel (no limit) is split into segments by message ID, which SCAN_CURSORS cursors read concurrently,
+    skipping what is already in scanned_ranges; segments gives the segments of an earlier run to continue instead.
+    Progress is checkpointed to the guild's data every CHECKPOINT_MESSAGES posts or CHECKPOINT_SECONDS, together
+    with what is needed to resume the scan from there, see resume_scan_args.
+    range_start is the newest message of an earlier, interrupted run of a scan that is not segmented.
+    """
+    if channel.id in active_scans:
+        raise ValueError(f"#{channel.name} is already being scanned")
+    scan = active_scans[channel.id] = Scan(channel)
+    channels, messages = scan_budget()
+    try:
+        async with channels:
+            result = await _scan_channel(channel, data, history_args, messages, until_message, force_rescan,
+                                         range_start, reply_channel, scan, segments)
+    except asyncio.CancelledError:
+        if scan.cancelled:
+            del_scan_record(data, channel)
+            raise ScanCancelled(f"Cancelled the scan of #{channel.name}.")
+        raise  # shutting down, the scan resumes on the next start
+    except Exception:
+        del_scan_record(data, channel)
+        raise
+    finally:
+        del active_scans[channel.id]
+    del_scan_record(data, channel)
+    return result
+
+
+async def _scan_channel(channel, data, history_args, message_slots, until_message, force_rescan, range_start,
+                        reply_channel, scan, segments):
     print(
         f"Scanning '#{channel.name}', {'all' if history_args.get('limit') is None else history_args['limit']} posts")
-    posts_skipped = 0
-    posts_scanned = 0
-    images_found = 0
-    image_errors = 0
+    limit = history_args.get("limit")
+    before = history_args.get("before")
     hashes = {}
-    first_message = None
-    last_message = None
+    unique_hashes = set()
     scanned_ranges = get_guild_data(
-        data, channel.guild, "scanned_ranges", default={}).get(str(channel.id), [])  # keys are stored as strings
-    async for m in channel.history(**history_args):
-        if until_message and m.id == until_message:
-            break
-        if (posts_scanned + posts_skipped) % 100 == 0:
-            if posts_scanned + posts_skipped == 0:
-                first_message = m.id
-            else:
+        data, channel.guild, "scanned_ranges", default={}).get(str(channel.id), IntervalSet(merge_touching=True))  # keys are stored as strings
+    messages = scan.messages = asyncio.Queue(SCAN_QUEUE_SIZE)
+    results = scan.results = asyncio.Queue()
+    if segments is None and limit is None and until_message is None and SCAN_CURSORS > 1:
+        segments = scan_segments(
+            channel, before, IntervalSet() if force_rescan else scanned_ranges)
+    if segments is not None:
+        spans = deque(segments)  # segments that no cursor has started on
+        cursors = []
+    else:
+        spans = None
+        cursors = [ScanCursor(history_args, start=range_start)]
+    last_checkpoint = time.monotonic()
+    since_checkpoint = 0
+
+    def checkpoint():
+        nonlocal hashes, last_checkpoint, since_checkpoint
+        add_hash_data(data, channel.guild, hashes)
+        hashes = {}
+        for cursor in cursors:
+            if (covered := cursor.covered()) is not None:
+                add_scanned_range(data, channel, covered)
+        if spans is not None:
+            cursors[:] = [c for c in cursors if not c.complete]
+            record = {"segments": [c.remaining() for c in cursors] + list(spans)}
+        else:
+            cursor = cursors[0]
+            record = {
+                "range_start": cursor.start or cursor.first_id,
+                "before": cursor.watermark_id or getattr(before, "id", before),
+                "limit": None if limit is None else limit - cursor.watermark - 1,
+            }
+        set_scan_record(data, channel, {
+            **record, "force_rescan": force_rescan, "reply_channel": reply_channel})
+        last_checkpoint = time.monotonic()
+        since_checkpoint = 0
+
+    async def produce(cursor):
+        async for m in channel.history(**cursor.history_args):
+            if until_message and m.id == until_message:
+                break
+            position = cursor.read
+            if position == 0:
+                cursor.first_id = m.id
+            if scan.read and scan.read % 100 == 0:
                 print(
-                    f"Scanned {posts_scanned}/{posts_scanned + posts_skipped} posts in '#{channel.name}'", m.jump_url)
-        last_message = m.id
-        if not force_rescan and num_in_ranges(scanned_ranges, m.id):
-            posts_skipped += 1
-            continue
-        embeds = image_hash_from_message(m)
-        for h in embeds["hashes"]:
-            if h in hashes:
-                hashes[h].append((channel.id, m.id))
+                    f"Read {scan.read} posts in '#{channel.name}', {scan.skipped} already scanned", m.jump_url)
+            cursor.read += 1
+            scan.read += 1
+            cursor.pending[position] = m.id
+            if not force_rescan and m.id in scanned_ranges:
+                scan.skipped += 1
+                cursor.finish(position)
+                continue
+            await messages.put((cursor, position, m))
+        cursor.exhausted = True
+
+    async def crawl():
+        while spans:
+            cursor = ScanCursor.segment(*spans.popleft())
+            cursors.append(cursor)
+            await produce(cursor)
+
+    async def work():
+        scheduler.set_priority(scheduler.SCAN)
+        while (item := await messages.get()) is not None:
+            cursor, position, m = item
+            async with message_slots:
+                embeds = await image_hash_from_message(m)
+            await results.put((cursor, position, m.id, embeds))
+
+    async def aggregate():
+        nonlocal since_checkpoint
+        while (result := await results.get()) is not None:
+            cursor, position, message_id, embeds = result
+            for h in embeds["hashes"]:
+                if h in hashes:
+                    hashes[h].append((channel.id, message_id))
+                else:
+                    hashes[h] = [(channel.id, message_id)]
+                unique_hashes.add(h)
+            scan.errors += embeds["errors"]
+            scan.scanned += 1
+            metrics.inc("scan_messages_total")
+            if embeds["transient"]:
+                # left unfinished, so that the scanned range stops before it and a later scan tries it again
+                scan.unfinished += 1
             else:
-                hashes[h] = [(channel.id, m.id)]
-
-        images_found += len(embeds["hashes"]) + embeds["errors"]
-        image_errors += embeds["errors"]
-        posts_scanned += 1
-    add_hash_data(data, channel.guild, hashes)
-    if last_message:
-        add_scanned_range(data, channel, (first_message, last_message))
-    return posts_scanned, posts_skipped, len(hashes), image_errors
+                cursor.finish(position)
+            since_checkpoint += 1
+            if since_checkpoint >= CHECKPOINT_MESSAGES or time.monotonic() - last_checkpoint >= CHECKPOINT_SECONDS:
+                checkpoint()
+
+    async def run():
+        await asyncio.gather(*producers)
+        for _ in workers:
+            await messages.put(None)
+        await asyncio.gather(*workers)
+        await results.put(None)
+        await aggregator
+
+    checkpoint()
+    workers = [asyncio.ensure_future(work()) for _ in range(SCAN_WORKERS)]
+    aggregator = asyncio.ensure_future(aggregate())
+    producers = [crawl() for _ in range(min(SCAN_CURSORS, len(spans)))] if spans is not None else [
+        produce(cursors[0])]
+    pipeline = asyncio.ensure_future(run())
+    tasks = [pipeline, *workers, aggregator]
+    try:
+        # the producers would wait forever on a full queue if the workers or the aggregator failed
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        # keep whatever was finished, even if the scan was cancelled or failed
+        checkpoint()
+    if scan.unfinished:
+        print(f"{scan.unfinished} posts in '#{channel.name}' had images that could not be downloaded for now, "
+              f"they are scanned again by the next scan")
+    return scan.scanned, scan.skipped, len(unique_hashes), scan.errors
+
+
+def set_scan_record(data, channel, record: dict):
+    scans = get_guild_data(data, channel.guild, "scans", default={})
+    scans[str(channel.id)] = record
+    set_guild_data(data, channel.guild, "scans", scans)
+
+
+def del_scan_record(data, channel):
+    scans = get_guild_data(data, channel.guild, "scans", default={})
+    if scans.pop(str(channel.id), None) is not None:
+        set_guild_data(data, channel.guild, "scans", scans)
+
+
+def resume_scan_args(record: dict):
+    """
+    Returns the history_args and scan_channel keyword arguments that continue a checkpointed scan.
+    """
+    if "segments" in record:
+        return {"limit": None}, {"force_rescan": record["force_rescan"], "segments": record["segments"]}
+    history_args = {"limit": record["limit"]}
+    if record["before"]:
+        history_args["before"] = discord.Object(record["before"])
+    return history_args, {"force_rescan": record["force_rescan"], "range_start": record["range_start"]}
 
 
 def add_scanned_range(data, channel, message_range: tuple):
-    message_range = (min(message_range), max(message_range))
     channels = get_guild_data(
         data, channel.guild, "scanned_ranges", default={})
     channel_id = str(channel.id)  # since JSON can only use strings as keys
     if str(channel_id) not in channels:
-        channels[channel_id] = []
-    add_range(channels[channel_id], message_range)
-    set_guild_data(data, channel.guild, "scanned_ranges", channels)
+        channels[channel_id] = IntervalSet(merge_touching=True)
+    channels[channel_id].add(*message_range)
+    guild_name, _ = unique_guild_data(channel.guild)
+    data[guild_name]["scanned_ranges"] = channels
+    with metrics.timer("storage_seconds", op="set_scanned_ranges"):
+        get_storage().set_scanned_ranges(
+            guild_name, channel.id, channels[channel_id])
 
 
-def save_guild_data(data, guild):
-    guild_name, server_file = unique_guild_data(guild)
-    with open(server_file, "w") as f:
-        json.dump(data[guild_name], f)
+def clear_scanned_ranges(data, guild, channel_ids):
+    guild_name, _ = unique_guild_data(guild)
+    channels = data[guild_name].get("scanned_ranges", {})
+    for channel_id in channel_ids:
+        if channels.pop(str(channel_id), None) is not None:
+            with metrics.timer("storage_seconds", op="set_scanned_ranges"):
+                get_storage().set_scanned_ranges(guild_name, channel_id, [])
+
+
+class GuildSettings:
+    """
+    The settings that on_message reads for every message, prepared once per guild. Updated by set_guild_data.
+    """
+    __slots__ = ("included_channels",)
+
+    def __init__(self, guild_data):
+        channels = set()
+        for c in guild_data.get("included_channels") or ():
+            # older versions of the include command stored lists of mentioned channels
+            channels.update(c if isinstance(c, list) else (c,))
+        self.included_channels = frozenset(channels)
+
+
+def get_settings(data, guild) -> GuildSettings:
+    settings = guild_settings.get(guild.id)
+    if settings is None:
+        guild_name, _ = unique_guild_data(guild)
+        settings = guild_settings[guild.id] = GuildSettings(data[guild_name])
+    return settings
+
+
+def jump_url(guild_id, channel_id, message_id):
+    return f"https://discord.com/channels/{guild_id}/{channel_id}/{message_id}"
 
 
 def get_guild_data(data, guild, k, default=None):
@@ -177,7 +553,9 @@ def get_guild_data(data, guild, k, default=None):
 def set_guild_data(data, guild, k, v):
     guild_name, _ = unique_guild_data(guild)
     data[guild_name][k] = v
-    save_guild_data(data, guild)
+    guild_settings.pop(guild.id, None)
+    with metrics.timer("storage_seconds", op="set_value"):
+        get_storage().set_value(guild_name, k, v)
 
 
 def del_guild_data(data, guild, k, raise_error=True):
@@ -187,53 +565,126 @@ def del_guild_data(data, guild, k, raise_error=True):
     except KeyError as e:
         if raise_error:
             raise e
-    save_guild_data(data, guild)
+    guild_settings.pop(guild.id, None)
+    with metrics.timer("storage_seconds", op="del_value"):
+        get_storage().del_value(guild_name, k)
 
 
 def add_hash_data(data, guild, hashes: dict):
     """
     Adds hashes to data.
     hashes should be a dict that maps the hash strings to a list (typically of tuples containing channel and message IDs).
-    Only unique list elements are added.
+    Only unique list elements are added, and only those are written to storage.
     """
-    if not get_guild_data(data, guild, "hashes"):
-        set_guild_data(data, guild, "hashes", {})
+    guild_name, _ = unique_guild_data(guild)
+    stored = data[guild_name].setdefault("hashes", HashStore())
+    index = get_hash_index(data, guild)
+    new_posts = {}
     for h, posts in hashes.items():
-        if h in get_guild_data(data, guild, "hashes", []):
-            for p in posts:
-                matching_posts = get_guild_data(data, guild, "hashes")[h]
-                if p in matching_posts:
-                    matching_posts.append(p)
+        if h not in stored:
+            stored.add_hash(h)
+            index.add(h)
+        for channel_id, message_id in posts:
+            if stored.add(h, channel_id, message_id):
+                new_posts.setdefault(h, []).append([channel_id, message_id])
+    if new_posts:
+        with metrics.timer("storage_seconds", op="add_postings"):
+            get_storage().add_postings(guild_name, new_posts)
+        if isinstance(data, GuildData):
+            data.grew(guild_name)
+
+
+def get_hash_index(data, guild) -> HashIndex:
+    guild_name, _ = unique_guild_data(guild)
+    if guild_name not in hash_indexes:
+        hashes = data[guild_name].get("hashes", {})
+        if CASCADE_DIFF >= 0:
+            index = CascadeIndex(
+                prefilter_diff=CASCADE_DIFF, audit=CASCADE_AUDIT)
         else:
-            get_guild_data(data, guild, "hashes", [])[h] = posts
-    save_guild_data(data, guild)
-
-
-async def load_data(client) -> dict:
-    data = {}
-    async for guild in client.fetch_guilds():
-        unique_guild, server_file = unique_guild_data(guild)
-        if not data.get(unique_guild):
-            data[unique_guild] = {}
-        with open(server_file, "a+") as f:
-            f.seek(0)
-            try:
-                if path.getsize(server_file) == 0:
-                    print("Created new file for", unique_guild)
-                    json.dump({}, f)
-                    data[unique_guild] = {}
-                else:
-                    data[unique_guild] = json.load(f)
-            except json.JSONDecodeError as e:
-                f.seek(0)
-                contents = f.read()
-                print(e, server_file, "contents:", contents)
-                data[unique_guild] = {}
-                with open(server_file + ".bak", "w") as backup:
-                    backup.write(contents)
-                f.seek(0)
-                json.dump({}, f)
-    return data
+            index = HashIndex()
+        if isinstance(hashes, HashStore):
+            index.extend_packed(hashes.matrix)
+        else:
+            index.extend(hashes)
+        hash_indexes[guild_name] = index
+    return hash_indexes[guild_name]
+
+
+def guild_size(guild_data):
+    """
+    Rough estimate of the memory held for a guild, in bytes.
+    """
+    hashes = guild_data.get("hashes", HashStore())
+    return hashes.nbytes + len(hashes) * INDEX_ENTRY_BYTES + 16 * sum(
+        len(r) for r in guild_data.get("scanned_ranges", {}).values())
+
+
+def save_snapshot(guild_name, guild_data):
+    with metrics.timer("storage_seconds", op="save_snapshot"):
+        try:
+            get_storage().save_snapshot(guild_name, guild_data.get("hashes"))
+        except OSError as e:
+            print(e, "Could not save a snapshot of", guild_name)
+
+
+class GuildData(dict):
+    """
+    Maps guild names to their data, like the dict the rest of the bot expects, but loads a guild from storage the
+    first time it is looked up. When the loaded guilds take up more than GUILD_CACHE_BYTES, the ones that were
+    used least recently are dropped again, except for guilds that are being scanned. This is checked when a guild
+    is loaded and when one grows. All changes are already in storage, so an evicted guild is simply loaded again on
+    its next use.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.recent = OrderedDict()  # guild names, least recently used first
+        self.last_evict = time.monotonic()
+        metrics.gauge("guilds_loaded", lambda: len(self))
+        metrics.gauge("guilds_loaded_bytes", lambda: sum(
+            guild_size(g) for g in self.values()))
+
+    def __getitem__(self, guild_name):
+        guild_data = super().__getitem__(guild_name)
+        self.recent[guild_name] = None
+        self.recent.move_to_end(guild_name)
+        return guild_data
+
+    def __missing__(self, guild_name):
+        with metrics.timer("storage_seconds", op="load_guild"):
+            guild_data = get_storage().load_guild(guild_name)
+        self[guild_name] = guild_data
+        hash_indexes.pop(guild_name, None)
+        self.evict(keep=guild_name)
+        return guild_data
+
+    def grew(self, guild_name):
+        """
+        Checks the cache size again after guild_name grew, at most every EVICT_SECONDS, as adding up the sizes of
+        the guilds is not free.
+        """
+        if time.monotonic() - self.last_evict >= EVICT_SECONDS:
+            self.evict(keep=guild_name)
+
+    def evict(self, keep=None):
+        self.last_evict = time.monotonic()
+        total = sum(guild_size(g) for g in self.values())
+        scanning = {unique_guild_data(s.channel.guild)[0]
+                    for s in active_scans.values()}
+        for guild_name in list(self.recent):
+            if total <= GUILD_CACHE_BYTES:
+                break
+            if guild_name == keep or guild_name in scanning:
+                continue
+            guild_data = super().__getitem__(guild_name)
+            total -= guild_size(guild_data)
+            save_snapshot(guild_name, guild_data)
+            del self[guild_name]
+            del self.recent[guild_name]
+            hash_indexes.pop(guild_name, None)
+            get_storage().unload_guild(guild_name)
+            print("Evicted idle guild", guild_name)
 
 
 def unique_guild_data(guild):
@@ -243,27 +694,48 @@ def unique_guild_data(guild):
     return (unique_name, file_name)
 
 
-def check_message(data, message, max_diff=0):
-    embeds = image_hash_from_message(message)
-    for h in embeds["hashes"]:
-        if max_diff == 0:
+async def check_message(data, message, max_diff=0):
+    with metrics.timer("check_message_seconds"):
+        return await _check_message(data, message, max_diff)
+
+
+async def _check_message(data, message, max_diff):
+    embeds = await image_hash_from_message(message)
+    if max_diff == 0:
+        for h in embeds["hashes"]:
             if h in get_guild_data(data, message.guild, "hashes", default=[]):
                 print("Found matching hash", h)
                 return get_guild_data(data, message.guild, "hashes")[h]
-        else:
-            for hash2 in get_guild_data(data, message.guild, "hashes", default=[]):
-                diff = hash_diff(h, hash2)
-                if diff < max_diff:
-                    print("Found matching hash", h, hash2, diff)
-                    return get_guild_data(data, message.guild, "hashes")[h]
+        return None
+    # all images of the message are looked up in one batch
+    index = get_hash_index(data, message.guild)
+    with metrics.timer("hash_lookup_seconds"):
+        found = index.query_many(embeds["hashes"], max_diff)
+    for h, matches in zip(embeds["hashes"], found):
+        if matches:
+            hash2, diff = matches[0]
+            print("Found matching hash", h, hash2, diff)
+            return get_guild_data(data, message.guild, "hashes")[hash2]
     return None
 
 
 class Client(discord.Client):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **options):
+        super().__init__(**options)
         self.command_strings = default_strings.copy()
+        self.metrics_server = None
+        self.http.request = self.timed_request(self.http.request)
+
+    @staticmethod
+    def timed_request(request):
+        """
+        Wraps discord.py's HTTP request method to time every Discord API call by route.
+        """
+        async def timed(route, **kwargs):
+            with metrics.timer("discord_api_seconds", route=f"{route.method} {route.path}"):
+                return await request(route, **kwargs)
+        return timed
 
     def check_command(self, message, command):
         return message.content.startswith(self.command_strings[command])
@@ -273,17 +745,68 @@ class Client(discord.Client):
 
     async def on_ready(self):
         print('We have logged in as {0.user}'.format(self))
-        self.data = await load_data(self)
+        if not hasattr(self, "data"):  # on_ready also runs after reconnecting
+            self.data = GuildData()
+        self.resume_scans()
+        if self.metrics_server is None:
+            # every shard process serves its metrics on its own port
+            self.metrics_server = await metrics.start_server(
+                metrics.METRICS_PORT and metrics.METRICS_PORT + (self.shard_id or 0))
+
+    def resume_scans(self):
+        """
+        Restarts scans that were interrupted by a restart, from their last checkpoint.
+        """
+        scans = get_storage().find_setting("scans")
+        for guild in self.guilds:
+            guild_name, _ = unique_guild_data(guild)
+            for channel_id, record in scans.get(guild_name, {}).items():
+                channel = guild.get_channel(int(channel_id))
+                if channel is None or channel.id in active_scans:
+                    continue
+                print(f"Resuming the scan of '#{channel.name}'")
+                history_args, scan_args = resume_scan_args(record)
+                asyncio.ensure_future(self.run_scan(channel, guild.get_channel(
+                    record["reply_channel"]), history_args, **scan_args))
+
+    async def run_scan(self, channel, reply_channel, history_args, **scan_args):
+        """
+        Scans a channel and reports the result in reply_channel, if there is one.
+        """
+        async def report(info_str):
+            print(info_str)
+            if reply_channel:
+                await reply_channel.send(info_str)
+
+        if channel.id in active_scans:
+            return await report(f"#{channel.name} is already being scanned.")
+        try:
+            scan_info = await scan_channel(channel, self.data, history_args,
+                                           reply_channel=reply_channel and reply_channel.id, **scan_args)
+        except discord.Forbidden:
+            return await report(f"I can't read the history of #{channel.name}.")
+        except ScanCancelled as e:
+            return await report(str(e))
+        await report(f"Done. Scanned {scan_info[0]}/{scan_info[0] + scan_info[1]} posts in #{channel.name}, found {scan_info[2]} unique images, {scan_info[3]} errors.")
+
+    async def close(self):
+        for guild_name, guild_data in getattr(self, "data", {}).items():
+            save_snapshot(guild_name, guild_data)
+        await fetch.close_session()
+        hashing.shutdown()
+        await super().close()
 
     async def on_guild_join(self, guild):
-        self.data = await load_data(self)
+        guild_name, _ = unique_guild_data(guild)
+        self.data[guild_name]  # loads the guild, creating it in storage if it is new
 
     async def on_message(self, message):
-        if message.author == client.user:
+        if message.author == self.user or message.guild is None:
             return
 
         # if message.author == message.guild.owner: #intents or some other junk broke this
         if message.author.id == message.guild.owner_id:
+            scheduler.set_priority(scheduler.COMMAND)
             if self.check_command(message, "hello"):
                 print("Hello there")
                 await message.reply('Hello there')
@@ -296,16 +819,24 @@ class Client(discord.Client):
                         channels = message.channel_mentions
                 else:
                     channels = [message.channel]
-                scanned_channels = get_guild_data(
-                    self.data, message.guild, "scanned_ranges")
-                for channel in channels:
-                    try:
-                        del scanned_channels[str(channel.id)]
-                    except KeyError:
-                        pass
-                save_guild_data(self.data, message.channel.guild)
+                clear_scanned_ranges(self.data, message.guild, [
+                                     c.id for c in channels])
                 await message.reply("Removed scan cache for: " + ", ".join([c.name for c in channels]))
 
+            elif self.check_command(message, "scan") and self.get_args(message, "scan")[:1] == ["status"]:
+                scans = [s for s in active_scans.values()
+                         if s.channel.guild == message.guild]
+                await message.reply("\n".join(str(s) for s in scans) or "No scans are running.")
+
+            elif self.check_command(message, "scan") and self.get_args(message, "scan")[:1] == ["cancel"]:
+                channel_ids = {c.id for c in message.channel_mentions}
+                scans = [s for s in active_scans.values() if s.channel.guild == message.guild and (
+                    not channel_ids or s.channel.id in channel_ids)]
+                for s in scans:
+                    s.cancel()
+                if not scans:
+                    await message.reply("No scans are running.")
+
             elif self.check_command(message, "scan"):
                 history_args = {
                     "limit": None,
@@ -320,18 +851,16 @@ class Client(discord.Client):
                         history_args["before"] = message
                         # history_args["oldest_first"] = None
                     elif w == "all":
-                        channels = message.guild.channels
+                        channels = message.guild.text_channels
                     elif w == "rescan":
                         force_rescan = True
                 if mentions := message.channel_mentions:
                     channels = mentions
                 async with message.channel.typing():
-                    await message.channel.send("Scanning posts...")
-                    for channel in channels:
-                        scan_info = await scan_channel(channel, self.data, history_args, force_rescan=force_rescan)
-                        info_str = f"Done. Scanned {scan_info[0]}/{scan_info[0] + scan_info[1]} posts in #{channel.name}, found {scan_info[2]} unique images, {scan_info[3]} errors."
-                        print(info_str)
-                        await message.channel.send(info_str)
+                    await message.channel.send(f"Scanning posts... Use `{self.command_strings['scan']} status` to see progress.")
+                    # channels are scanned concurrently, up to SCAN_CHANNELS at a time
+                    await asyncio.gather(*[self.run_scan(c, message.channel, history_args, force_rescan=force_rescan)
+                                           for c in channels])
 
             elif self.check_command(message, "hash"):
                 if message.reference:
@@ -344,10 +873,32 @@ class Client(discord.Client):
                         print(
                             "Discord refused to find the message this one references.")
                     elif isinstance(m, discord.Message):
-                        await message.reply(str(image_hash_from_message(m)))
+                        await message.reply(str(await image_hash_from_message(m)))
                 else:
                     await message.reply("Reply to a message to trigger this command.")
 
+            elif self.check_command(message, "stats"):
+                stats = metrics.summary() or "Nothing measured yet."
+                if len(stats) <= 1900:
+                    await message.reply(f"```\n{stats}\n```")
+                else:
+                    # the counters and gauges come first, the whole summary is attached
+                    head = stats[:1900].rsplit("\n", 1)[0]
+                    await message.reply(f"```\n{head}\n```",
+                                        file=discord.File(BytesIO(stats.encode()), "stats.txt"))
+
+            elif self.check_command(message, "profile"):
+                args = self.get_args(message, "profile")
+                seconds = float(args[0]) if args and args[0].replace(".", "", 1).isdecimal() else 30
+                seconds = min(seconds, MAX_PROFILE_SECONDS)
+                if profiler.capturing:
+                    await message.reply("A profile is already being captured.")
+                else:
+                    await message.reply(f"Profiling for {seconds:g}s...")
+                    file_name, stats = await profiler.capture(seconds)
+                    top = profiler.top_functions(stats)
+                    await message.reply(f"Saved to `{file_name}`.\n```\n{top[:1800]}\n```")
+
             elif self.check_command(message, "hashdiff"):
                 words = self.get_args(message, "hashdiff")
                 if len(words) != 2:
@@ -363,8 +914,8 @@ class Client(discord.Client):
                     try:
                         m1 = await message.channel.fetch_message(words[0])
                         m2 = await message.channel.fetch_message(words[1])
-                        h1 = image_hash_from_message(m1)
-                        h2 = image_hash_from_message(m2)
+                        h1, h2 = await asyncio.gather(
+                            image_hash_from_message(m1), image_hash_from_message(m2))
                         if not h1["hashes"]:
                             await message.reply("1st message had no hashable images.")
                         elif not h2["hashes"]:
@@ -383,53 +934,86 @@ class Client(discord.Client):
 
             elif self.check_command(message, "include"):
                 args = self.get_args(message, "include")
-                channels = get_guild_data(
-                    self.data, message.guild, "included_channels")
+                channels = list(get_settings(
+                    self.data, message.guild).included_channels)
                 if args and args[0] == "all":
                     channels = [c.id for c in message.guild.channels]
                 elif args and args[0] == "none":
                     channels = []
                 else:
-                    channels.append([c.id for c in message.channel_mentions])
+                    channels.extend(c.id for c in message.channel_mentions if c.id not in channels)
                 set_guild_data(self.data, message.guild,
                                "included_channels", channels)
                 await message.reply("Checking the following channels for reposts:" + ", ".join([str(message.guild.get_channel(c)) for c in channels]))
 
             elif self.check_command(message, "exclude"):
                 args = self.get_args(message, "exclude")
-                channels = get_guild_data(
-                    self.data, message.guild, "included_channels")
+                channels = list(get_settings(
+                    self.data, message.guild).included_channels)
                 if args and args[0] == "all":
                     channels = []
                 elif args and args[0] == "none":
                     channels = [c.id for c in message.guild.channels]
                 else:
-                    try:
-                        channels.remove(
-                            [c.id for c in message.channel_mentions])
-                    except ValueError:
+                    mentioned = {c.id for c in message.channel_mentions}
+                    if mentioned <= set(channels):
+                        channels = [c for c in channels if c not in mentioned]
+                    else:
                         await message.reply("A mentioned channel was not in the list. List not updated.")
 
                 set_guild_data(self.data, message.guild,
                                "included_channels", channels)
                 await message.reply("Checking the following channels for reposts:" + ", ".join([str(message.guild.get_channel(c)) for c in channels]))
 
-        if message.channel.id in get_guild_data(self.data, message.guild, "included_channels", []) and (match := check_message(self.data, message, SAME_DIFF)):
-            jump = None
-            try:
-                channel = message.guild.get_channel(match[0][0])
-                jump = await channel.fetch_message(match[0][1])
-                jump = " " + jump.jump_url
-            finally:
-                await message.reply(self.command_strings["repost_found"] + (jump if jump else ""))
+        # the repost check: most messages have no images or are in channels that are not checked
+        if not (message.attachments or message.embeds):
+            return
+        if message.channel.id not in get_settings(self.data, message.guild).included_channels:
+            return
+        scheduler.set_priority(scheduler.LIVE)
+        if match := await check_message(self.data, message, SAME_DIFF):
+            channel_id, message_id = match[0]
+            await message.reply(self.command_strings["repost_found"] + " " +
+                                jump_url(message.guild.id, channel_id, message_id))
 
 
-if __name__ == '__main__':
-    client = Client()
+def run_shard(token, shard_id=None, shard_count=None):
+    Client(shard_id=shard_id, shard_count=shard_count).run(token)
 
+
+def run_shards(token):
+    """
+    Runs each shard in SHARD_IDS in its own process, and restarts shards that crash. The processes only share the
+    storage (REPOSTI_DB) and the hash cache, which are SQLite files in WAL mode that allow concurrent writers; each
+    guild belongs to exactly one shard, so its data and index live in one process only.
+    """
+    # split the cores between the shards' hashing pools
+    environ.setdefault("REPOSTI_HASH_WORKERS", str(
+        max(1, (cpu_count() or 1) // len(SHARD_IDS))))
+    context = multiprocessing.get_context("spawn")
+    shards = {}
+    while True:
+        for shard_id in SHARD_IDS:
+            process = shards.get(shard_id)
+            if process is not None and process.exitcode == 0:
+                continue  # shut down cleanly
+            if process is None or process.exitcode is not None:
+                if process is not None:
+                    print(f"Shard {shard_id} exited with {process.exitcode}, restarting it")
+                shards[shard_id] = context.Process(target=run_shard, args=(token, shard_id, SHARD_COUNT),
+                                                   name=f"reposti-shard-{shard_id}")
+                shards[shard_id].start()
+        if all(p.exitcode == 0 for p in shards.values()):
+            return
+        time.sleep(5)
+
+
+if __name__ == '__main__':
     token = environ.get("REPOSTI_DISCORD_TOKEN")
-    if token:
-        client.run(token)
-    else:
+    if not token:
         print("No Discord token found. Run the image with the correct environment variable set.")
         exit("")
+    if SHARD_COUNT > 1:
+        run_shards(token)
+    else:
+        run_shard(token)
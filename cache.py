@@ -0,0 +1,184 @@
+"""
+Cache of image hashes, so the same image is not downloaded or hashed twice, and of images that could not be hashed,
+so they are not retried until their failure expires.
+"""
+import hashlib
+import metrics
+import sqlite3
+import time
+from collections import OrderedDict
+from os import environ, makedirs, path
+
+CACHE_SIZE = int(environ.get("REPOSTI_HASH_CACHE_SIZE", 100000))
+# file for the on-disk tier, set to an empty string to keep the cache in memory only
+CACHE_FILE = environ.get("REPOSTI_HASH_CACHE",
+                         path.join("data", "hash_cache.sqlite3"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS by_key (
+    key TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS by_digest (
+    digest BLOB PRIMARY KEY,
+    hash TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS failures (
+    key TEXT PRIMARY KEY,
+    error TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+_cache = None
+
+
+def hit_ratio():
+    lookups = {result: metrics.count("hash_cache_lookups_total", result=result)
+               for result in ("key", "digest", "miss")}
+    total = sum(lookups.values())
+    return (lookups["key"] + lookups["digest"]) / total if total else 0
+
+
+metrics.gauge("hash_cache_hit_ratio", hit_ratio)
+metrics.gauge("hash_cache_entries", lambda: len(_cache.keys) if _cache else 0)
+
+
+class CachedFailure(Exception):
+    """
+    Raised instead of downloading an image whose last attempt failed recently, with the kind of that failure.
+    """
+
+    def __init__(self, error, kind):
+        super().__init__(error)
+        self.kind = kind
+
+
+def digest(img_data: bytes) -> bytes:
+    return hashlib.blake2b(img_data, digest_size=16).digest()
+
+
+class LRU:
+    """
+    A dict with at most maxsize entries that drops the least recently used entry when full.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, k, default=None):
+        try:
+            self.entries.move_to_end(k)
+        except KeyError:
+            return default
+        return self.entries[k]
+
+    def put(self, k, v):
+        self.entries[k] = v
+        self.entries.move_to_end(k)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class HashCache:
+    """
+    Two levels: image keys (attachment IDs or URLs) to hashes, which saves the download, and digests of the downloaded
+    bytes to hashes, which saves decoding and hashing when the same file is posted under a new URL. Both are kept in a
+    bounded in-memory LRU in front of an optional SQLite file that survives restarts.
+    Image keys that failed are kept the same way with the error and when it expires.
+    """
+
+    def __init__(self, size=CACHE_SIZE, db_file=CACHE_FILE):
+        self.keys = LRU(size)
+        self.digests = LRU(size)
+        self.failures = LRU(size)  # key -> (error, kind, expires)
+        self.db = None
+        if db_file:
+            if path.dirname(db_file):
+                makedirs(path.dirname(db_file), exist_ok=True)
+            # shard processes share the file, see storage.SQLiteStorage
+            self.db = sqlite3.connect(
+                db_file, timeout=30, isolation_level="IMMEDIATE")
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+            if "kind" not in {column[1] for column in self.db.execute("PRAGMA table_info(failures)")}:
+                self.db.execute("DROP TABLE IF EXISTS failures")  # from before failures had a kind
+            self.db.executescript(SCHEMA)
+            with self.db:
+                self.db.execute("DELETE FROM failures WHERE expires < ?", (time.time(),))
+
+    def _get(self, lru, table, column, k):
+        h = lru.get(k)
+        if h is None and self.db is not None:
+            row = self.db.execute(
+                f"SELECT hash FROM {table} WHERE {column} = ?", (k,)).fetchone()
+            if row:
+                h = row[0]
+                lru.put(k, h)
+        return h
+
+    def get_key(self, key: str):
+        h = self._get(self.keys, "by_key", "key", key)
+        if h is not None:
+            metrics.inc("hash_cache_lookups_total", result="key")
+        return h
+
+    def get_digest(self, img_digest: bytes):
+        h = self._get(self.digests, "by_digest", "digest", img_digest)
+        metrics.inc("hash_cache_lookups_total",
+                    result="digest" if h is not None else "miss")
+        return h
+
+    def put(self, key: str, img_digest: bytes, h: str):
+        """
+        Caches a hash by its image key and by the digest of its bytes, or only by the digest if key is None.
+        """
+        if key is not None:
+            self.keys.put(key, h)
+        self.digests.put(img_digest, h)
+        if self.db is not None:
+            with self.db:
+                if key is not None:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO by_key (key, hash) VALUES (?, ?)", (key, h))
+                self.db.execute(
+                    "INSERT OR REPLACE INTO by_digest (digest, hash) VALUES (?, ?)", (img_digest, h))
+
+    def get_failure(self, key: str):
+        """
+        Returns the error and the kind of the last failure of key, or None if it has not failed or its failure
+        expired.
+        """
+        failure = self.failures.get(key)
+        if failure is None and self.db is not None:
+            failure = self.db.execute(
+                "SELECT error, kind, expires FROM failures WHERE key = ?", (key,)).fetchone()
+            if failure:
+                self.failures.put(key, failure)
+        if failure is None or failure[2] < time.time():
+            return None
+        metrics.inc("hash_cache_lookups_total", result="failure")
+        return failure[:2]
+
+    def put_failure(self, key: str, error: str, kind: str, ttl: float):
+        """
+        Remembers that key failed with error for ttl seconds.
+        """
+        failure = (error, kind, time.time() + ttl)
+        self.failures.put(key, failure)
+        if self.db is not None:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO failures (key, error, kind, expires) VALUES (?, ?, ?, ?)",
+                                (key, *failure))
+
+
+def get_hash_cache():
+    global _cache
+    if _cache is None:
+        _cache = HashCache()
+    return _cache
@@ -0,0 +1,249 @@
+"""
+Image downloads on a shared, connection-pooled aiohttp session so that slow CDNs never block the event loop.
+"""
+import asyncio
+import aiohttp
+import metrics
+import time
+from contextlib import asynccontextmanager
+from os import environ
+from scheduler import PRIORITY_NAMES, PriorityGate
+from urllib.parse import urlparse
+
+DOWNLOAD_TIMEOUT = float(environ.get("REPOSTI_DOWNLOAD_TIMEOUT", 30))
+DOWNLOAD_RETRIES = int(environ.get("REPOSTI_DOWNLOAD_RETRIES", 2))
+RETRY_BACKOFF = 0.5
+# longest Retry-After that is waited for, beyond it the download fails instead of holding its caller
+MAX_RETRY_DELAY = float(environ.get("REPOSTI_MAX_RETRY_DELAY", DOWNLOAD_TIMEOUT))
+MAX_CONNECTIONS = int(environ.get("REPOSTI_MAX_CONNECTIONS", 64))
+MAX_CONNECTIONS_PER_HOST = int(environ.get(
+    "REPOSTI_MAX_CONNECTIONS_PER_HOST", 8))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_DOWNLOAD_BYTES = int(environ.get(
+    "REPOSTI_MAX_DOWNLOAD_BYTES", 16 * 2 ** 20))
+CHUNK_SIZE = 2 ** 16
+# a host that fails this many downloads in a row is not downloaded from for BREAKER_COOLDOWN seconds
+BREAKER_FAILURES = int(environ.get("REPOSTI_BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN = float(environ.get("REPOSTI_BREAKER_COOLDOWN", 30))
+
+_session = None
+# downloads are handed out by priority up to the per-host connection limit, rather than queueing first come first
+# served in the connector. Each host has its own gate, so a busy CDN does not hold up downloads from other hosts.
+# Gates are dropped once idle, as any host can be linked, and are reported together as resource="downloads"
+_gates = {}  # host -> PriorityGate
+for _priority, _priority_name in enumerate(PRIORITY_NAMES):
+    metrics.gauge("queue_waiting", lambda p=_priority: sum(len(gate.waiters[p]) for gate in _gates.values()),
+                  resource="downloads", priority=_priority_name)
+metrics.gauge("queue_in_use", lambda: sum(gate.in_use for gate in _gates.values()), resource="downloads")
+metrics.gauge("download_hosts", lambda: len(_gates))
+
+
+class DownloadTooLarge(aiohttp.ClientError):
+    pass
+
+
+class CircuitOpen(aiohttp.ClientError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Counts the transient failures (timeouts, connection errors and retryable statuses) of each host in a row. After
+    `failures` of them the host is open: downloads from it fail at once with CircuitOpen, without taking a download
+    slot. After `cooldown` seconds a single download is let through to probe the host, which closes it again if it
+    succeeds and keeps it open for another cooldown if it fails. Hosts that have not failed for two cooldowns are
+    forgotten, see prune.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.failed = {}  # host -> transient failures in a row
+        self.last_failure = {}  # host -> time.monotonic() of its last failure
+        self.open_until = {}  # host -> time.monotonic() when it may be probed
+        self.probing = set()
+        self.pruned = time.monotonic()
+        metrics.gauge("circuits_open", self.open_count)
+
+    def open_count(self):
+        now = time.monotonic()
+        return sum(until > now or host in self.probing for host, until in self.open_until.items())
+
+    def allow(self, host, probe=True):
+        """
+        Returns whether a download from host may start. The first download after the cooldown is the probe, and
+        must be followed by success, failure or done; with probe=False it is only checked whether one could start.
+        """
+        until = self.open_until.get(host)
+        if until is None:
+            return True
+        if host in self.probing or time.monotonic() < until:
+            metrics.inc("circuit_rejections_total")
+            return False
+        if probe:
+            self.probing.add(host)
+        return True
+
+    def success(self, host):
+        self.failed.pop(host, None)
+        self.last_failure.pop(host, None)
+        self.open_until.pop(host, None)
+        self.probing.discard(host)
+
+    def failure(self, host):
+        now = time.monotonic()
+        if now - self.pruned > self.cooldown:
+            self.prune(now)
+        self.failed[host] = self.failed.get(host, 0) + 1
+        self.last_failure[host] = now
+        if host in self.probing or self.failed[host] >= self.failures:
+            if host not in self.open_until:
+                print("Not downloading from", host, "after", self.failed[host], "failures in a row")
+                metrics.inc("circuits_opened_total")
+            self.open_until[host] = now + self.cooldown
+        self.probing.discard(host)
+
+    def prune(self, now):
+        """
+        Forgets the hosts that last failed more than two cooldowns ago and are not being probed: their failures are
+        no longer in a row, and their circuits were free to be probed for a whole cooldown without anyone trying.
+        """
+        self.pruned = now
+        for host, last in list(self.last_failure.items()):
+            if now - last > 2 * self.cooldown and host not in self.probing:
+                del self.last_failure[host]
+                self.failed.pop(host, None)
+                self.open_until.pop(host, None)
+
+    def done(self, host):
+        """
+        Ends a probe that neither succeeded nor failed, such as a cancelled download.
+        """
+        self.probing.discard(host)
+
+
+breaker = CircuitBreaker()
+
+
+@asynccontextmanager
+async def download_slot(host):
+    """
+    Holds one of the host's download slots, see _gates.
+    """
+    gate = _gates.get(host)
+    if gate is None:
+        gate = _gates[host] = PriorityGate("downloads", MAX_CONNECTIONS_PER_HOST, gauges=False)
+    try:
+        async with gate:
+            yield
+    finally:
+        if gate.idle() and _gates.get(host) is gate:
+            del _gates[host]
+
+
+def get_session():
+    """
+    Returns the shared session, creating it on first use. Must be called from a coroutine.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS_PER_HOST),
+            timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT))
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def retry_delay(attempt, response=None):
+    """
+    Exponential backoff, or the server's Retry-After if it sent one. Returns None if the server asks to wait longer
+    than MAX_RETRY_DELAY.
+    """
+    if response is not None:
+        try:
+            delay = max(float(response.headers.get("Retry-After")), 0)
+        except (TypeError, ValueError):
+            pass
+        else:
+            return delay if delay <= MAX_RETRY_DELAY else None
+    return min(RETRY_BACKOFF * 2 ** attempt, MAX_RETRY_DELAY)
+
+
+async def read_capped(response, url):
+    """
+    Streams the body of response, giving up as soon as it is larger than MAX_DOWNLOAD_BYTES.
+    """
+    if response.content_length and response.content_length > MAX_DOWNLOAD_BYTES:
+        raise DownloadTooLarge(f"{url} is {response.content_length} bytes")
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        body += chunk
+        if len(body) > MAX_DOWNLOAD_BYTES:
+            raise DownloadTooLarge(
+                f"{url} is more than {MAX_DOWNLOAD_BYTES} bytes")
+    return bytes(body)
+
+
+async def download(url):
+    """
+    Returns the body of url. Timeouts, connection errors and retryable statuses are retried with backoff,
+    anything else (including bodies over MAX_DOWNLOAD_BYTES) raises aiohttp.ClientError or asyncio.TimeoutError.
+    Hosts that keep failing raise CircuitOpen without being contacted, see CircuitBreaker.
+    """
+    try:
+        with metrics.timer("download_seconds"):
+            body = await _download(url)
+    except Exception as e:
+        metrics.inc("downloads_total", result=type(e).__name__)
+        raise
+    metrics.inc("downloads_total", result="ok")
+    metrics.inc("download_bytes_total", len(body))
+    return body
+
+
+async def _download(url):
+    session = get_session()
+    host = urlparse(url).hostname
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        delay = None
+        try:
+            # checked before waiting for a slot, so that doomed downloads do not queue, and again once a slot is
+            # free, as the host may have failed while this download waited
+            if not breaker.allow(host, probe=False):
+                raise CircuitOpen(f"{host} is failing, not downloading {url}")
+            async with download_slot(host):
+                if not breaker.allow(host):
+                    raise CircuitOpen(f"{host} is failing, not downloading {url}")
+                try:
+                    async with session.get(url) as response:
+                        if response.status in RETRY_STATUSES:
+                            breaker.failure(host)
+                        else:
+                            breaker.success(host)  # even a 404 shows the host is up
+                        if response.status in RETRY_STATUSES and attempt < DOWNLOAD_RETRIES:
+                            delay = retry_delay(attempt, response)
+                        if delay is None:
+                            response.raise_for_status()
+                            return await read_capped(response, url)
+                except (aiohttp.ClientResponseError, DownloadTooLarge):
+                    raise
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    breaker.failure(host)
+                    raise
+                finally:
+                    breaker.done(host)
+        except (aiohttp.ClientResponseError, DownloadTooLarge, CircuitOpen):
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+        await asyncio.sleep(delay)
+
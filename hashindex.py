@@ -0,0 +1,271 @@
+"""
+Hamming-space index over the hex image hashes of a guild.
+"""
+import metrics
+import numpy as np
+import random
+from collections import defaultdict
+from itertools import combinations
+
+HASH_BITS = 256
+HASH_BYTES = HASH_BITS // 8
+CHUNKS = 16
+BLOCK_ROWS = 1 << 16  # rows per block when scanning the whole matrix, bounds temporary memory
+PREFILTER_DIFF = 7  # largest coarse_hash distance that CascadeIndex passes on to the full comparison
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def pack(hashes, n_bytes=HASH_BYTES) -> np.ndarray:
+    """
+    Packs hex hashes into a (len(hashes), n_bytes) uint8 matrix, one hash per row.
+    """
+    packed = b"".join(bytes.fromhex(h) for h in hashes)
+    return np.frombuffer(packed, dtype=np.uint8).reshape(-1, n_bytes).copy()
+
+
+def popcount(x: np.ndarray) -> np.ndarray:
+    """
+    Counts the set bits of a packed uint8 array along its last axis.
+    """
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(x).sum(axis=-1, dtype=np.int32)
+    return _POPCOUNT[x].sum(axis=-1, dtype=np.int32)
+
+
+def hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Returns the (len(a), len(b)) matrix of Hamming distances between two packed hash matrices.
+    """
+    out = np.empty((len(a), len(b)), dtype=np.int32)
+    word = np.uint64 if a.shape[1] % 8 == 0 else np.uint8  # XOR whole words where the width allows it
+    a_words = a.view(word)
+    for start in range(0, len(b), BLOCK_ROWS):
+        b_words = b[start:start + BLOCK_ROWS].view(word)
+        xor = a_words[:, None, :] ^ b_words[None, :, :]
+        out[:, start:start + BLOCK_ROWS] = popcount(
+            xor.view(np.uint8).reshape(len(a), len(b_words), a.shape[1]))
+    return out
+
+
+def hash_distance(h1: str, h2: str) -> int:
+    return int(hamming(pack([h1], len(h1) // 2), pack([h2], len(h2) // 2))[0, 0])
+
+
+class HashIndex:
+    """
+    Multi-index hashing over a packed hash matrix: every hash is split into `chunks` substrings, each of which is
+    kept in its own table. If two hashes are within distance r, then by the pigeonhole principle at least one pair of
+    substrings is within distance r // chunks, so a radius query only probes a handful of buckets per table and then
+    checks the candidate rows with one vectorized XOR and popcount.
+    """
+
+    def __init__(self, hashes=(), bits=HASH_BITS, chunks=CHUNKS):
+        if bits % chunks or bits // chunks not in (8, 16, 32):
+            raise ValueError("Chunks must be 8, 16 or 32 bits wide")
+        self.bits = bits
+        self.chunks = chunks
+        self.chunk_bits = bits // chunks
+        self.chunk_dtype = np.dtype(f"<u{self.chunk_bits // 8}")
+        self.rows = {}  # hash bytes -> row
+        self.tables = [defaultdict(list) for _ in range(chunks)]
+        self._matrix = np.zeros((0, bits // 8), dtype=np.uint8)
+        self.extend(hashes)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, h):
+        return bytes.fromhex(h) in self.rows
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[:len(self.rows)]
+
+    def split(self, packed: np.ndarray) -> np.ndarray:
+        """
+        Returns the chunk values of packed hashes as a (len(packed), chunks) matrix.
+        """
+        return packed.view(self.chunk_dtype)
+
+    def extend(self, hashes):
+        """
+        Adds hex hashes. Hashes that are already indexed are ignored.
+        """
+        self.extend_packed(pack(list(hashes), self.bits // 8))
+
+    def extend_packed(self, packed: np.ndarray):
+        """
+        Adds the rows of a packed hash matrix, such as HashStore.matrix. Hashes that are already indexed are ignored.
+        """
+        raw = packed.tobytes()
+        n = self.bits // 8
+        start = len(self.rows)
+        new = []
+        for i in range(0, len(raw), n):
+            key = raw[i:i + n]
+            if key not in self.rows:
+                self.rows[key] = start + len(new)
+                new.append(key)
+        if not new:
+            return
+        end = start + len(new)
+        if len(new) != len(packed):
+            packed = np.frombuffer(b"".join(new), dtype=np.uint8).reshape(-1, n)
+        if end > len(self._matrix):
+            grown = np.zeros(
+                (max(end, 2 * len(self._matrix)), n), dtype=np.uint8)
+            grown[:start] = self.matrix
+            self._matrix = grown
+        self._matrix[start:end] = packed
+        for table, column in zip(self.tables, self.split(packed).T.tolist()):
+            for row, key in enumerate(column, start):
+                table[key].append(row)
+
+    def add(self, h: str):
+        self.extend([h])
+
+    def neighbours(self, key: int, radius: int):
+        """
+        Yields every chunk value within radius of key.
+        """
+        for r in range(radius + 1):
+            for bits in combinations(range(self.chunk_bits), r):
+                flipped = key
+                for b in bits:
+                    flipped ^= 1 << b
+                yield flipped
+
+    def candidates(self, chunks, radius: int):
+        found = set()
+        for table, key in zip(self.tables, chunks):
+            for k in self.neighbours(key, radius // self.chunks):
+                found.update(table.get(k, ()))
+        return found
+
+    def distances(self, hashes) -> np.ndarray:
+        """
+        Returns the (len(hashes), len(self)) matrix of distances from each hex hash to every indexed hash.
+        """
+        return hamming(pack(hashes, self.bits // 8), self.matrix)
+
+    def query_rows(self, packed: np.ndarray, max_diff: int):
+        """
+        Returns, for each row of a packed hash matrix, the indexed rows with diff < max_diff and their diffs, as two
+        arrays, closest first. All candidates of the batch are compared in a single matrix operation.
+        """
+        if max_diff <= 0 or not len(packed) or not self.rows:
+            empty = np.zeros(0, dtype=np.int64)
+            return [(empty, empty) for _ in range(len(packed))]
+        if (max_diff - 1) // self.chunks >= self.chunk_bits:
+            rows = np.arange(len(self.rows))
+        else:
+            found = set()
+            for chunks in self.split(packed).tolist():
+                found |= self.candidates(chunks, max_diff - 1)
+            rows = np.fromiter(found, dtype=np.int64, count=len(found))
+        diffs = hamming(packed, self._matrix[rows])
+        out = []
+        for row_diffs in diffs:
+            close = np.flatnonzero(row_diffs < max_diff)
+            close = close[np.argsort(row_diffs[close], kind="stable")]
+            out.append((rows[close], row_diffs[close]))
+        return out
+
+    def query_many(self, hashes, max_diff: int):
+        """
+        Returns, for each hex hash, a list of (hash, diff) for indexed hashes with diff < max_diff, closest first.
+        """
+        return [[(self._matrix[row].tobytes().hex(), int(diff)) for row, diff in zip(rows, diffs)]
+                for rows, diffs in self.query_rows(pack(hashes, self.bits // 8), max_diff)]
+
+    def query(self, h: str, max_diff: int):
+        """
+        Returns a list of (hash, diff) for indexed hashes with diff < max_diff, closest first.
+        """
+        return self.query_many([h], max_diff)[0]
+
+
+def coarse_hash(packed: np.ndarray, side=16) -> np.ndarray:
+    """
+    Reduces packed side x side bit hashes to (side / 2)^2 bits, each set when at least 2 of its 2x2 block are.
+    For the 16x16 whash that is a 64 bit average hash of the wavelet low band at 8x8.
+    """
+    bits = np.unpackbits(packed, axis=1).reshape(len(packed), side // 2, 2, side // 2, 2)
+    return np.packbits(bits.sum(axis=(2, 4), dtype=np.uint8) >= 2, axis=1).reshape(len(packed), -1)
+
+
+class CascadeIndex:
+    """
+    Two stage matching: candidates are found by their 64 bit coarse_hash in a small HashIndex, within
+    prefilter_diff, and only those are compared on all 256 bits. A fraction `audit` of the queries is also answered
+    by the full index alone, and what the cascade missed is counted, so that the cascade_recall gauge shows how
+    many true matches prefilter_diff loses.
+    """
+
+    def __init__(self, hashes=(), prefilter_diff=PREFILTER_DIFF, audit=0.0):
+        self.full = HashIndex()
+        self.coarse = HashIndex(bits=HASH_BITS // 4, chunks=4)
+        self.members = []  # coarse row -> full rows with that coarse hash
+        self.prefilter_diff = prefilter_diff
+        self.audit = audit
+        self.extend(hashes)
+
+    def __len__(self):
+        return len(self.full)
+
+    def __contains__(self, h):
+        return h in self.full
+
+    def extend(self, hashes):
+        self.extend_packed(pack(list(hashes)))
+
+    def extend_packed(self, packed: np.ndarray):
+        start = len(self.full)
+        self.full.extend_packed(packed)
+        coarse = coarse_hash(self.full.matrix[start:])
+        self.coarse.extend_packed(coarse)
+        self.members.extend([] for _ in range(len(self.coarse) - len(self.members)))
+        raw = coarse.tobytes()
+        n = coarse.shape[1]
+        for row, i in enumerate(range(0, len(raw), n), start):
+            self.members[self.coarse.rows[raw[i:i + n]]].append(row)
+
+    def add(self, h: str):
+        self.extend([h])
+
+    def query_many(self, hashes, max_diff: int):
+        """
+        Same as HashIndex.query_many, but only the hashes that pass the prefilter are compared.
+        """
+        if max_diff <= 0 or not hashes or not len(self.full):
+            return [[] for _ in hashes]
+        packed = pack(hashes)
+        out = []
+        for query, (coarse_rows, _) in zip(packed, self.coarse.query_rows(coarse_hash(packed),
+                                                                           self.prefilter_diff + 1)):
+            rows = np.fromiter((row for c in coarse_rows for row in self.members[c]), dtype=np.int64)
+            diffs = hamming(query[None, :], self.full._matrix[rows])[0]
+            close = np.flatnonzero(diffs < max_diff)
+            close = close[np.argsort(diffs[close], kind="stable")]
+            metrics.inc("cascade_candidates_total", len(rows))
+            metrics.inc("cascade_matches_total", len(close))
+            out.append([(self.full._matrix[rows[i]].tobytes().hex(), int(diffs[i])) for i in close])
+        if self.audit and random.random() < self.audit:
+            for found, expected in zip(out, self.full.query_many(hashes, max_diff)):
+                metrics.inc("cascade_audit_expected_total", len(expected))
+                metrics.inc("cascade_audit_found_total", len(found))
+        return out
+
+    def query(self, h: str, max_diff: int):
+        return self.query_many([h], max_diff)[0]
+
+
+def _ratio(numerator, denominator):
+    total = metrics.count(denominator)
+    return metrics.count(numerator) / total if total else 1.0
+
+
+# share of the candidates that were true matches, and of the true matches in audited queries that were found
+metrics.gauge("cascade_precision", lambda: _ratio("cascade_matches_total", "cascade_candidates_total"))
+metrics.gauge("cascade_recall", lambda: _ratio("cascade_audit_found_total", "cascade_audit_expected_total"))
@@ -0,0 +1,169 @@
+"""
+Image decoding and hashing, run in a process pool so that CPU-bound work stays off the event loop.
+"""
+import asyncio
+import cProfile
+import imagehash
+import metrics
+import profiler
+import multiprocessing
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from os import cpu_count, environ
+from PIL import Image
+from scheduler import PriorityGate
+
+HASH_SIZE = 16
+HASH_WORKERS = int(environ.get("REPOSTI_HASH_WORKERS", cpu_count() or 1))
+MAX_IN_FLIGHT = int(environ.get(
+    "REPOSTI_HASH_IN_FLIGHT", 2 * max(HASH_WORKERS, 1)))
+# images are hashed at this resolution at most, which is far more than a 16x16 hash can tell apart. The reduced
+# decode is not bit for bit the whash of the full image: hashes move by a few bits (up to 2 on bench.py's corpus), so
+# exact lookups (max_diff 0) can miss hashes stored by versions that decoded at full size. 0 decodes at full size.
+DECODE_SCALE = int(environ.get("REPOSTI_DECODE_SCALE", 256))
+MAX_PIXELS = int(environ.get("REPOSTI_MAX_PIXELS", 50_000_000))
+TIME_BUDGET = float(environ.get("REPOSTI_HASH_TIME_BUDGET", 10))  # seconds per image
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class OutOfTime(TimeoutError):
+    pass
+
+
+# everything hash_bytes can raise for a single bad image
+HASH_ERRORS = (OSError, ValueError, Image.DecompressionBombError,
+               BrokenProcessPool, asyncio.TimeoutError)
+
+_pool = None
+_slots = PriorityGate("hashing", MAX_IN_FLIGHT)
+in_flight = 0
+metrics.gauge("hash_in_flight", lambda: in_flight)
+
+
+def decode_scale(size):
+    """
+    The side of the square that whash resizes an image of this size to: the largest power of 2 that fits in the
+    image, capped at DECODE_SCALE. Capping it moves the hash by a few bits at most, since only the 16x16 low band
+    is kept.
+    """
+    natural_scale = 1 << (max(min(size), 1).bit_length() - 1)
+    return max(min(natural_scale, DECODE_SCALE), HASH_SIZE)
+
+
+def _hash_image(img_data: bytes):
+    """
+    Returns the hash and the seconds spent decoding and hashing.
+    """
+    start = time.perf_counter()
+    img = Image.open(BytesIO(img_data))  # only reads the header
+    if img.width * img.height > MAX_PIXELS:
+        raise ImageTooLarge(f"{img.width}x{img.height} image")
+    if DECODE_SCALE:
+        scale = decode_scale(img.size)
+        # JPEGs are decoded straight to a reduced size (1/2 to 1/8) that is still at least scale x scale
+        img.draft("L", (scale, scale))
+    else:
+        scale = None  # the full image, as whash scales it by default
+    # convert loads the current frame only, which for animations is the first one
+    img = img.convert("L")
+    decoded = time.perf_counter()
+    h = str(imagehash.whash(img, hash_size=HASH_SIZE, image_scale=scale))
+    return h, decoded - start, time.perf_counter() - decoded
+
+
+def _out_of_time(signum, frame):
+    raise OutOfTime(f"Image took more than {TIME_BUDGET}s to hash")
+
+
+def hash_image(img_data: bytes) -> str:
+    """
+    Decodes an image and returns its wavelet hash as a hex string.
+    """
+    return hash_image_timed(img_data)[0]
+
+
+def hash_image_timed(img_data: bytes):
+    """
+    Returns the hash of an image with the seconds spent decoding and hashing. Runs in the worker processes,
+    where an alarm stops images that take longer than TIME_BUDGET.
+    """
+    if not TIME_BUDGET or threading.current_thread() is not threading.main_thread():
+        return _hash_image(img_data)
+    previous = signal.signal(signal.SIGALRM, _out_of_time)
+    signal.setitimer(signal.ITIMER_REAL, TIME_BUDGET)
+    try:
+        return _hash_image(img_data)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def hash_image_profiled(img_data: bytes):
+    """
+    hash_image_timed under cProfile, for captures with `reposti profile`. Returns its result and the raw stats.
+    """
+    profile = cProfile.Profile()
+    result = profile.runcall(hash_image_timed, img_data)
+    profile.create_stats()
+    return result, profile.stats
+
+
+def get_pool():
+    """
+    Returns the shared hashing pool, or None to hash in the event loop's default thread pool
+    when REPOSTI_HASH_WORKERS is 0.
+    """
+    global _pool
+    if _pool is None and HASH_WORKERS > 0:
+        _pool = ProcessPoolExecutor(
+            HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+    _pool = None
+
+
+async def hash_bytes(img_data: bytes) -> str:
+    """
+    Hashes an image in the pool. At most MAX_IN_FLIGHT images are queued on the pool at once;
+    other callers wait here by priority, so a scan cannot bury live checks under a backlog of pool work.
+    Images that are too large or too slow to hash raise one of HASH_ERRORS.
+    """
+    global in_flight
+    with metrics.timer("hash_wait_seconds"):
+        await _slots.acquire()
+    in_flight += 1
+    pool = get_pool()
+    profiling = profiler.capturing
+    try:
+        # the worker stops itself after TIME_BUDGET, this is only a backstop
+        result = await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(
+                pool, hash_image_profiled if profiling else hash_image_timed, img_data),
+            TIME_BUDGET * 2 if TIME_BUDGET else None)
+    except BrokenProcessPool:
+        # a worker died (e.g. killed for memory); start a fresh pool for the next image
+        if _pool is pool:
+            shutdown()
+        raise
+    finally:
+        in_flight -= 1
+        _slots.release()
+    if profiling:
+        result, stats = result
+        profiler.add_worker_stats(stats)
+    h, decode_seconds, whash_seconds = result
+    metrics.observe("decode_seconds", decode_seconds)
+    metrics.observe("whash_seconds", whash_seconds)
+    return h
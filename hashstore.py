@@ -0,0 +1,242 @@
+"""
+Compact in-memory store of a guild's image hashes and where they were posted, and its binary snapshot file.
+"""
+import numpy as np
+from array import array
+from hashindex import HASH_BYTES, pack
+from os import makedirs, path, replace
+
+MAGIC = b"RPSTHSH2"
+HEADER = np.dtype([("magic", "S8"), ("hash_bytes", "<u8"),
+                   ("hashes", "<u8"), ("postings", "<u8"), ("version", "<u8")])
+ROW_BYTES = 120  # the rows dict entry of a hash and its key, roughly
+
+
+class HashStore:
+    """
+    The hashes of a guild with their postings, readable like the dict of hex strings to lists of
+    [channel ID, message ID] it replaces. Hashes are the rows of a packed uint8 matrix, found through a dict of their
+    raw bytes. Postings loaded in bulk are one int64 (n, 2) array with an offset per row, and postings added later
+    are flat int64 arrays per row, so there is no Python object per hash or posting. compact() merges the two.
+    """
+
+    def __init__(self, hash_bytes=HASH_BYTES):
+        self.hash_bytes = hash_bytes
+        self.rows = {}  # hash bytes -> row
+        self._matrix = np.zeros((0, hash_bytes), dtype=np.uint8)
+        # the bulk postings of row i are _postings[_offsets[i]:_offsets[i + 1]], rows past the end have none
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._postings = np.zeros((0, 2), dtype=np.int64)
+        self._added = {}  # row -> array("q") of channel, message pairs added after the bulk load
+        self.version = 0  # the version of the stored hashes that a snapshot was saved at, see save()
+
+    @classmethod
+    def from_postings(cls, postings, hash_bytes=HASH_BYTES):
+        """
+        Builds a store from (hex hash, channel ID, message ID) tuples, grouped by hash. A hash with no postings is
+        given once with a channel ID of None.
+        """
+        hashes = []
+        counts = array("q")
+        flat = array("q")
+        last = None
+        for h, channel, message in postings:
+            if h != last:
+                hashes.append(h)
+                counts.append(0)
+                last = h
+            if channel is not None:
+                counts[-1] += 1
+                flat.append(channel)
+                flat.append(message)
+        return cls._bulk(hashes, counts, flat, hash_bytes)
+
+    @classmethod
+    def from_dict(cls, hashes: dict, hash_bytes=HASH_BYTES):
+        """
+        Builds a store from a dict of hex hashes to lists of (channel ID, message ID), the JSON format.
+        """
+        return cls.from_postings(((h, *p) for h, posts in hashes.items() for p in (posts or [(None, None)])),
+                                 hash_bytes)
+
+    @classmethod
+    def _bulk(cls, hashes, counts, flat, hash_bytes):
+        store = cls(hash_bytes)
+        packed = pack(hashes, hash_bytes)
+        store._set_rows(packed)
+        store._matrix = packed
+        store._offsets = np.zeros(len(hashes) + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(counts, dtype=np.int64),
+                  out=store._offsets[1:])
+        store._postings = np.frombuffer(flat, dtype=np.int64).reshape(-1, 2)
+        return store
+
+    def _set_rows(self, packed: np.ndarray):
+        raw = packed.tobytes()
+        n = self.hash_bytes
+        self.rows = {raw[i:i + n]: row
+                     for row, i in enumerate(range(0, len(raw), n))}
+        if len(self.rows) != len(packed):
+            raise ValueError("Duplicate hashes")
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        raw = self.matrix.tobytes()
+        n = self.hash_bytes
+        return (raw[i:i + n].hex() for i in range(0, len(raw), n))
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for row, h in enumerate(self):
+            yield h, self.posts(row)
+
+    def _row(self, h: str):
+        try:
+            return self.rows.get(bytes.fromhex(h))
+        except (TypeError, ValueError):
+            return None
+
+    def __contains__(self, h):
+        return self._row(h) is not None
+
+    def __getitem__(self, h: str):
+        row = self._row(h)
+        if row is None:
+            raise KeyError(h)
+        return self.posts(row)
+
+    def get(self, h: str, default=None):
+        row = self._row(h)
+        return default if row is None else self.posts(row)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[:len(self.rows)]
+
+    @property
+    def posting_count(self):
+        return len(self._postings) + sum(len(a) for a in self._added.values()) // 2
+
+    @property
+    def nbytes(self):
+        """
+        Rough estimate of the memory used by the store, in bytes.
+        """
+        return (self._matrix.nbytes + self._offsets.nbytes + self._postings.nbytes + len(self.rows) * ROW_BYTES
+                + sum(64 + a.itemsize * len(a) for a in self._added.values()))
+
+    def posts(self, row: int):
+        """
+        Returns the postings of a row as a list of [channel ID, message ID].
+        """
+        if row + 1 < len(self._offsets):
+            posts = self._postings[self._offsets[row]:self._offsets[row + 1]].tolist()
+        else:
+            posts = []
+        added = self._added.get(row)
+        if added:
+            posts.extend([added[i], added[i + 1]]
+                         for i in range(0, len(added), 2))
+        return posts
+
+    def add_hash(self, h: str) -> int:
+        """
+        Adds a hex hash without postings if it is new. Returns its row.
+        """
+        key = bytes.fromhex(h)
+        if len(key) != self.hash_bytes:
+            raise ValueError(f"Expected a {2 * self.hash_bytes} digit hash")
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.rows)
+            if row == len(self._matrix):
+                grown = np.zeros(
+                    (max(16, 2 * row), self.hash_bytes), dtype=np.uint8)
+                grown[:row] = self._matrix
+                self._matrix = grown
+            self._matrix[row] = np.frombuffer(key, dtype=np.uint8)
+            self.rows[key] = row
+        return row
+
+    def add(self, h: str, channel: int, message: int) -> bool:
+        """
+        Adds a posting of a hex hash. Returns whether it was new.
+        """
+        row = self.add_hash(h)
+        if [channel, message] in self.posts(row):
+            return False
+        self._added.setdefault(row, array("q")).extend((channel, message))
+        return True
+
+    def compact(self):
+        """
+        Merges the postings added since the bulk load into the bulk arrays.
+        """
+        n = len(self.rows)
+        if not self._added and len(self._offsets) == n + 1:
+            return
+        bulk_counts = np.zeros(n, dtype=np.int64)
+        bulk_counts[:len(self._offsets) - 1] = np.diff(self._offsets)
+        counts = bulk_counts.copy()
+        for row, added in self._added.items():
+            counts[row] += len(added) // 2
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        postings = np.empty((offsets[-1], 2), dtype=np.int64)
+        # each bulk posting moves by the number of postings added to the rows before its own
+        bulk_rows = np.repeat(np.arange(n), bulk_counts)
+        postings[np.arange(len(self._postings)) + offsets[bulk_rows] -
+                 self._offsets[bulk_rows]] = self._postings
+        for row, added in self._added.items():
+            end = offsets[row + 1]
+            postings[end - len(added) // 2:end] = np.frombuffer(added,
+                                                                dtype=np.int64).reshape(-1, 2)
+        self._offsets = offsets
+        self._postings = postings
+        self._added = {}
+
+    def save(self, file_name, version=0):
+        """
+        Writes a snapshot: a header, the hash matrix, the row offsets and the postings, as little endian arrays that
+        load() maps into memory without parsing. The file is replaced atomically. version is kept in the header, so
+        that the storage can tell whether the snapshot is still up to date.
+        """
+        self.compact()
+        header = np.array([(MAGIC, self.hash_bytes, len(self.rows), len(self._postings), version)], dtype=HEADER)
+        if path.dirname(file_name):
+            makedirs(path.dirname(file_name), exist_ok=True)
+        with open(file_name + ".tmp", "wb") as f:
+            header.tofile(f)
+            np.ascontiguousarray(self.matrix).tofile(f)
+            self._offsets.astype("<i8").tofile(f)
+            self._postings.astype("<i8").tofile(f)
+        replace(file_name + ".tmp", file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Maps a snapshot written by save() into memory. Raises ValueError if the file is not a valid snapshot.
+        """
+        header = np.fromfile(file_name, dtype=HEADER, count=1)
+        if len(header) != 1 or header["magic"][0] != MAGIC:
+            raise ValueError(f"{file_name} is not a hash snapshot")
+        hash_bytes, n, m = (int(header[k][0])
+                            for k in ("hash_bytes", "hashes", "postings"))
+        start = HEADER.itemsize
+        sizes = (n * hash_bytes, 8 * (n + 1), 16 * m)
+        if path.getsize(file_name) != start + sum(sizes):
+            raise ValueError(f"{file_name} is truncated")
+        store = cls(hash_bytes)
+        store.version = int(header["version"][0])
+        if n:
+            store._matrix = np.memmap(file_name, dtype=np.uint8, mode="r", offset=start, shape=(n, hash_bytes))
+            store._offsets = np.memmap(file_name, dtype="<i8", mode="r", offset=start + sizes[0], shape=(n + 1,))
+        if m:
+            store._postings = np.memmap(file_name, dtype="<i8", mode="r", offset=start + sizes[0] + sizes[1],
+                                        shape=(m, 2))
+        store._set_rows(store._matrix)
+        return store
@@ -0,0 +1,191 @@
+"""
+Offline bulk indexer for channel exports, so that the bot starts with a warm index instead of crawling history.
+
+    python -m indexer exports/ --workers 8
+
+Reads JSON channel exports in the DiscordChatExporter format (a "guild", a "channel" and its "messages"), with the
+attachments downloaded next to them (--media). Images are hashed in the hashing process pool and written with
+add_hash_data and add_scanned_range, exactly as `reposti scan` would, to the storage configured by REPOSTI_STORAGE
+and REPOSTI_DB. Messages with linked images that were not downloaded, or that failed for now, are not marked as scanned,
+so that `reposti scan` still hashes them. Stop the bot while indexing, as it does not see changes to guilds it has already loaded.
+"""
+import argparse
+import asyncio
+import json
+import time
+from glob import glob
+from os import environ, path
+from types import SimpleNamespace
+from urllib.parse import unquote, urlparse
+
+BATCH_MESSAGES = 500  # messages hashed and written together
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".jfif",
+                    ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+
+
+def find_exports(paths):
+    """
+    Returns the JSON files given, and the ones in the directories given, recursively.
+    """
+    files = []
+    for p in paths:
+        if path.isdir(p):
+            files.extend(sorted(glob(path.join(p, "**", "*.json"), recursive=True)))
+        else:
+            files.append(p)
+    return files
+
+
+def is_remote(url):
+    return urlparse(url).scheme in ("http", "https")
+
+
+def local_file(export_file, url):
+    """
+    Returns the path of an attachment that was downloaded with the export. Exports store them relative to the JSON
+    file, sometimes percent-encoded.
+    """
+    file_name = path.join(path.dirname(export_file), url)
+    if not path.isfile(file_name) and path.isfile(path.join(path.dirname(export_file), unquote(url))):
+        file_name = path.join(path.dirname(export_file), unquote(url))
+    return file_name
+
+
+def message_images(message):
+    """
+    Returns (cache key, url) for the images of an exported message, chosen the way image_hash_from_message does.
+    Embed images that were downloaded with the export have no key, as the bot caches them by their original URL.
+    """
+    urls = []
+    for embed in message.get("embeds", ()):
+        for k in ("thumbnail", "image"):
+            if (embed.get(k) or {}).get("url"):
+                url = embed[k]["url"]
+                urls.append((url if is_remote(url) else None, url))
+                break
+    for attachment in message.get("attachments", ()):
+        if path.splitext(attachment.get("fileName", ""))[1].lower() in IMAGE_EXTENSIONS:
+            urls.append((f"attachment:{attachment['id']}", attachment["url"]))
+    return urls
+
+
+def read_file(file_name):
+    with open(file_name, "rb") as f:
+        return f.read()
+
+
+async def read_local(file_name):
+    return await asyncio.get_running_loop().run_in_executor(None, read_file, file_name)
+
+
+async def hash_image(export_file, key, url, download):
+    import bot
+    import fetch
+    if not is_remote(url):
+        return await bot.hash_cached(key, read_local, local_file(export_file, url))
+    if download:
+        return await bot.hash_cached(key, fetch.download, url)
+    return None
+
+
+async def index_export(data, export_file, args):
+    """
+    Hashes the images of one export and stores them. Returns the number of messages indexed, messages skipped
+    because they were already scanned, images hashed, remote images skipped and errors.
+    """
+    import bot
+    with open(export_file, encoding="utf-8") as f:
+        export = json.load(f)
+    if "guild" not in export or "channel" not in export or "messages" not in export:
+        print("Skipping", export_file, "as it is not a channel export")
+        return 0, 0, 0, 0, 0
+    guild = SimpleNamespace(id=int(export["guild"]["id"]), name=export["guild"]["name"])
+    channel = SimpleNamespace(id=int(export["channel"]["id"]), name=export["channel"]["name"], guild=guild)
+    messages = sorted(export["messages"], key=lambda m: int(m["id"]))
+    scanned_ranges = bot.get_guild_data(data, guild, "scanned_ranges", {}).get(str(channel.id), ())
+    indexed = skipped = hashed = remote = errors = 0
+    run_start = None  # first message of the run of messages indexed with all their images, up to the last batch
+    for start in range(0, len(messages), BATCH_MESSAGES):
+        batch = messages[start:start + BATCH_MESSAGES]
+        jobs = []  # (message ID, url, hash coroutine)
+        incomplete = set()  # messages with images that were not hashed, or failed for now
+        for message in batch:
+            message_id = int(message["id"])
+            if not args.force and message_id in scanned_ranges:
+                skipped += 1
+                continue
+            indexed += 1
+            for key, url in message_images(message):
+                jobs.append((message_id, url, hash_image(export_file, key, url, args.download)))
+        results = await asyncio.gather(*[job for _, _, job in jobs], return_exceptions=True)
+        hashes = {}
+        for (message_id, url, _), result in zip(jobs, results):
+            if isinstance(result, bot.IMAGE_ERRORS):
+                errors += 1
+                if bot.is_transient(result) or bot.failure_kind(result) is None:
+                    incomplete.add(message_id)  # may be hashed on a later run, e.g. once a missing file is there
+                print(repr(result), url)
+            elif isinstance(result, BaseException):
+                raise result
+            elif result is None:
+                remote += 1
+                incomplete.add(message_id)
+            else:
+                hashed += 1
+                hashes.setdefault(result, []).append((channel.id, message_id))
+        bot.add_hash_data(data, guild, hashes)
+        runs = [] if run_start is None else [[run_start, run_start]]
+        for message in batch:
+            message_id = int(message["id"])
+            if message_id in incomplete:
+                run_start = None
+                continue
+            if run_start is None:
+                run_start = message_id
+                runs.append([run_start, message_id])
+            runs[-1][1] = message_id
+        for run in runs:
+            bot.add_scanned_range(data, channel, tuple(run))
+    print(f"Indexed #{channel.name} from {export_file}: {indexed} posts, skipped {skipped}, {hashed} images, "
+          f"{remote} linked images not downloaded, {errors} errors")
+    return indexed, skipped, hashed, remote, errors
+
+
+async def run(args):
+    import bot
+    import fetch
+    import hashing
+    data = bot.GuildData()
+    totals = [0] * 5
+    started = time.perf_counter()
+    try:
+        for export_file in find_exports(args.paths):
+            totals = [t + n for t, n in zip(totals, await index_export(data, export_file, args))]
+    finally:
+        for guild_name, guild_data in data.items():
+            bot.save_snapshot(guild_name, guild_data)
+        await fetch.close_session()
+        hashing.shutdown()
+    indexed, skipped, hashed, remote, errors = totals
+    print(f"Done in {time.perf_counter() - started:.0f}s: {indexed} posts, skipped {skipped}, {hashed} images, "
+          f"{remote} linked images not downloaded, {errors} errors")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("paths", nargs="+", help="export JSON files, or directories to search for them")
+    parser.add_argument("--workers", type=int,
+                        help="hashing processes, REPOSTI_HASH_WORKERS by default")
+    parser.add_argument("--download", action="store_true",
+                        help="download images that the export only links to, instead of skipping them")
+    parser.add_argument("--force", action="store_true",
+                        help="index messages in ranges that were already scanned too")
+    args = parser.parse_args(argv)
+    if args.workers is not None:  # read by hashing when it is imported
+        environ["REPOSTI_HASH_WORKERS"] = str(args.workers)
+        environ.pop("REPOSTI_HASH_IN_FLIGHT", None)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+In-process counters, gauges and timing histograms for the hot paths, readable with `reposti stats` or in the
+Prometheus text format from an optional local HTTP endpoint (REPOSTI_METRICS_PORT).
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import environ
+
+METRICS_PORT = int(environ.get("REPOSTI_METRICS_PORT", 0))
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+histograms = {}  # (name, labels) -> Histogram
+counters = {}  # (name, labels) -> number
+gauges = {}  # (name, labels) -> function returning the current value
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket that holds the q-th quantile.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    if key not in histograms:
+        histograms[key] = Histogram()
+    histograms[key].observe(value)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Records how long the block took in the histogram name, in seconds. Works around awaits too.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def inc(name, n=1, **labels):
+    key = _key(name, labels)
+    counters[key] = counters.get(key, 0) + n
+
+
+def count(name, **labels):
+    return counters.get(_key(name, labels), 0)
+
+
+def gauge(name, fn, **labels):
+    """
+    Registers fn, which returns the current value of the gauge, to be called whenever metrics are read.
+    """
+    gauges[_key(name, labels)] = fn
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render_prometheus():
+    lines = []
+    typed = set()
+
+    def header(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), fn in sorted(gauges.items(), key=lambda g: g[0]):
+        header(name, "gauge")
+        lines.append(f"{name}{_format_labels(labels)} {fn()}")
+    for (name, labels), h in sorted(histograms.items(), key=lambda h: h[0]):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(BUCKETS + ("+Inf",), h.counts):
+            cumulative += n
+            lines.append(
+                f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {h.sum}")
+        lines.append(f"{name}_count{_format_labels(labels)} {h.count}")
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """
+    A short human readable summary: counters and gauges, then per-stage count, mean and approximate p50/p99.
+    Histograms come last as they have the most series, so that a cut summary keeps the rest.
+    """
+    lines = []
+    for (name, labels), value in sorted(counters.items()):
+        lines.append(f"{name}{_format_labels(labels)}: {value}")
+    for (name, labels), fn in sorted(gauges.items(), key=lambda g: g[0]):
+        lines.append(f"{name}{_format_labels(labels)}: {fn()}")
+    for (name, labels), h in sorted(histograms.items(), key=lambda h: h[0]):
+        if h.count:
+            lines.append(f"{name}{_format_labels(labels)}: {h.count}x, mean {1000 * h.sum / h.count:.1f}ms, "
+                         f"p50 <{1000 * h.quantile(0.5):g}ms, p99 <{1000 * h.quantile(0.99):g}ms")
+    return "\n".join(lines)
+
+
+async def start_server(port=METRICS_PORT):
+    """
+    Serves /metrics on localhost. Returns the aiohttp runner, or None if no port is configured.
+    """
+    if not port:
+        return None
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render_prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    print(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+    return runner
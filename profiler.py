@@ -0,0 +1,75 @@
+"""
+On-demand profiling of the running bot, see `reposti profile`. Nothing is profiled outside of a capture.
+"""
+import asyncio
+import cProfile
+import io
+import pstats
+import time
+from os import makedirs, path
+
+PROFILE_DIR = "data"
+
+capturing = False  # checked by hashing.hash_bytes to profile pool work as well
+_worker_stats = []  # raw stats returned by profiled pool jobs during the current capture
+
+
+class _RawStats:
+    """
+    Lets pstats load the stats dict of a profile that ran in another process.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def add_worker_stats(stats: dict):
+    if capturing:
+        _worker_stats.append(stats)
+
+
+async def capture(seconds: float, directory=PROFILE_DIR):
+    """
+    Profiles the event loop thread, and every image hashed in the worker pool, for the given number of seconds.
+    Writes the combined stats to a .pstats file in directory and returns its path and the stats.
+    """
+    global capturing
+    if capturing:
+        raise RuntimeError("A profile is already being captured")
+    capturing = True
+    _worker_stats.clear()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profile.disable()
+        capturing = False
+    stats = pstats.Stats(profile)
+    for worker_stats in _worker_stats:
+        stats.add(_RawStats(worker_stats))
+    _worker_stats.clear()
+    makedirs(directory, exist_ok=True)
+    file_name = path.join(
+        directory, time.strftime("profile-%Y%m%d-%H%M%S.pstats"))
+    stats.dump_stats(file_name)
+    return file_name, stats
+
+
+def top_functions(stats: pstats.Stats, n=15):
+    """
+    Returns the n functions with the most cumulative time, one per line.
+    """
+    stats.stream = io.StringIO()
+    stats.sort_stats("cumulative")
+    lines = []
+    for func in stats.fcn_list[:n]:
+        calls, _, total_time, cumulative_time, _ = stats.stats[func]
+        file_name, line, name = func
+        where = f"{path.basename(file_name)}:{line}({name})" if line else name
+        lines.append(
+            f"{cumulative_time:8.3f}s {total_time:8.3f}s {calls:>8} {where}")
+    return "  cumulative    total    calls function\n" + "\n".join(lines)
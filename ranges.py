@@ -0,0 +1,86 @@
+"""
+Sorted sets of disjoint, inclusive integer ranges, used to remember which messages of a channel were scanned.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class IntervalSet:
+    """
+    Sorted, disjoint ranges kept as two parallel arrays of starts and ends, so that lookups are a bisect and adding a
+    range is a bisect plus one slice assignment, without a list per range.
+    Touching ranges like [1, 2] and [3, 4] are kept apart, as the lists of ranges stored before did, unless
+    merge_touching is set. Scanned message IDs set it, since no message can be between them.
+    """
+    __slots__ = ("starts", "ends", "merge_touching")
+
+    def __init__(self, ranges=(), merge_touching=False):
+        self.starts = array("q")
+        self.ends = array("q")
+        self.merge_touching = merge_touching
+        for start, end in ranges:
+            self.add(start, end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __contains__(self, num: int):
+        i = bisect_right(self.starts, num) - 1
+        return i >= 0 and num <= self.ends[i]
+
+    def __eq__(self, other):
+        return isinstance(other, IntervalSet) and self.starts == other.starts and self.ends == other.ends
+
+    def __repr__(self):
+        return f"IntervalSet({self.to_list()})"
+
+    def add(self, start: int, end: int):
+        if start > end:
+            start, end = end, start
+        reach = 1 if self.merge_touching else 0
+        i = bisect_left(self.ends, start - reach)  # first range that ends at or after start
+        j = bisect_right(self.starts, end + reach)  # first range that starts after end
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = array("q", [start])
+        self.ends[i:j] = array("q", [end])
+
+    def gaps(self, start: int, end: int):
+        """
+        Returns the parts of [start, end] that are not in the set, as a list of [start, end] lists.
+        """
+        out = []
+        i = bisect_left(self.ends, start)  # first range that ends at or after start
+        while start <= end:
+            if i == len(self.starts) or self.starts[i] > end:
+                out.append([start, end])
+                break
+            if self.starts[i] > start:
+                out.append([start, self.starts[i] - 1])
+            start = self.ends[i] + 1
+            i += 1
+        return out
+
+    def to_list(self):
+        """
+        Returns the ranges as a list of [start, end] lists, the format they are stored in.
+        """
+        return [[start, end] for start, end in self]
+
+
+def split_ranges(ranges, n: int, min_size=1):
+    """
+    Splits a list of ranges into about n pieces of similar length, as [start, end] lists. A piece never spans two
+    ranges, so there are more pieces than n when there are more ranges. Pieces are at least min_size long, except
+    for ranges that are shorter, which are one piece.
+    """
+    size = max(min_size, -(-sum(end - start + 1 for start, end in ranges) // max(n, 1)))
+    out = []
+    for start, end in ranges:
+        step = -(-(end - start + 1) // -(-(end - start + 1) // size))  # equal pieces of at most size
+        out.extend([s, min(s + step - 1, end)] for s in range(start, end + 1, step))
+    return out
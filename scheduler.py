@@ -0,0 +1,89 @@
+"""
+Priority classes for the bot's work, and gates that hand out downloads and hashing slots by priority, so that
+repost checks on new messages are not stuck behind a scan's backlog.
+"""
+import asyncio
+import contextvars
+import metrics
+import time
+from collections import deque
+from os import environ
+
+LIVE, COMMAND, SCAN = range(3)  # highest priority first
+PRIORITY_NAMES = ("live", "command", "scan")
+# slots of each gate that scans never take, so that live work can start at once
+LIVE_RESERVED = int(environ.get("REPOSTI_LIVE_RESERVED", 2))
+
+# the priority of the work the current task does; tasks inherit it from the task that created them
+current_priority = contextvars.ContextVar("priority", default=LIVE)
+
+
+def set_priority(priority):
+    current_priority.set(priority)
+
+
+class PriorityGate:
+    """
+    A semaphore whose waiters are served highest priority first. Lower priorities are paused while higher ones wait,
+    and scans leave `reserved` slots free. The time spent waiting is recorded in queue_wait_seconds. Gates that share
+    a name report their waiters and slots in use through gauges of their own, pass gauges=False.
+    """
+
+    def __init__(self, name, slots, reserved=LIVE_RESERVED, gauges=True):
+        self.name = name
+        self.slots = slots
+        self.reserved = min(reserved, slots - 1)
+        self.in_use = 0
+        self.waiters = [deque() for _ in PRIORITY_NAMES]
+        if gauges:
+            self.register_gauges()
+
+    def register_gauges(self):
+        name = self.name
+        for priority, priority_name in enumerate(PRIORITY_NAMES):
+            metrics.gauge("queue_waiting", lambda p=priority: len(self.waiters[p]),
+                          resource=name, priority=priority_name)
+        metrics.gauge("queue_in_use", lambda: self.in_use, resource=name)
+
+    def idle(self):
+        return self.in_use == 0 and not any(self.waiters)
+
+    def free(self, priority):
+        return self.slots - self.in_use - (self.reserved if priority == SCAN else 0)
+
+    async def acquire(self, priority=None):
+        if priority is None:
+            priority = current_priority.get()
+        start = time.perf_counter()
+        if self.free(priority) > 0 and not any(self.waiters[p] for p in range(priority + 1)):
+            self.in_use += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters[priority].append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.release()  # the slot was handed over just as the waiter was cancelled
+                elif waiter in self.waiters[priority]:  # release() drops cancelled waiters it comes across
+                    self.waiters[priority].remove(waiter)
+                raise
+        metrics.observe("queue_wait_seconds", time.perf_counter() - start,
+                        resource=self.name, priority=PRIORITY_NAMES[priority])
+
+    def release(self):
+        self.in_use -= 1
+        for priority, waiters in enumerate(self.waiters):
+            while waiters and self.free(priority) > 0:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self.in_use += 1
+                    waiter.set_result(None)
+            if waiters:
+                break  # everything below waits for this priority
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,381 @@
+"""
+Persistent guild data. Changes are written as incremental updates instead of rewriting everything a guild has stored.
+"""
+import json
+import sqlite3
+from glob import glob
+from hashstore import HashStore
+from os import environ, makedirs, path, remove, rename
+from ranges import IntervalSet
+
+DATA_DIR = "data"
+STORAGE = environ.get("REPOSTI_STORAGE", "sqlite")
+DB_FILE = environ.get("REPOSTI_DB", path.join(DATA_DIR, "reposti.sqlite3"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS settings (
+    guild TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (guild, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    hash BLOB NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS guild_hashes (
+    guild TEXT NOT NULL,
+    image_id INTEGER NOT NULL REFERENCES images (id),
+    PRIMARY KEY (guild, image_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS guild_postings (
+    guild TEXT NOT NULL,
+    image_id INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    message INTEGER NOT NULL,
+    PRIMARY KEY (guild, image_id, channel, message),
+    FOREIGN KEY (guild, image_id) REFERENCES guild_hashes (guild, image_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hashes_versions (
+    guild TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS scanned_ranges (
+    guild TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    PRIMARY KEY (guild, channel, start)
+) WITHOUT ROWID;
+"""
+
+_storage = None
+
+
+def _to_json(o):
+    if isinstance(o, IntervalSet):
+        return o.to_list()
+    if isinstance(o, HashStore):
+        return dict(o.items())
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+class JSONStorage:
+    """
+    The original format: one data/<name>_<id>.json file per guild. Every change rewrites the guild's whole file.
+    """
+
+    def __init__(self, directory=DATA_DIR):
+        self.directory = directory
+        self.guilds = {}  # guild name -> the dict returned by load_guild, which the bot updates in place
+        makedirs(directory, exist_ok=True)
+
+    def file_name(self, guild_name):
+        return path.join(self.directory, guild_name + ".json")
+
+    def load_guild(self, guild_name) -> dict:
+        server_file = self.file_name(guild_name)
+        guild_data = {}
+        with open(server_file, "a+") as f:
+            f.seek(0)
+            try:
+                if path.getsize(server_file) == 0:
+                    print("Created new file for", guild_name)
+                    json.dump({}, f)
+                else:
+                    guild_data = json.load(f)
+            except json.JSONDecodeError as e:
+                f.seek(0)
+                contents = f.read()
+                print(e, server_file, "contents:", contents)
+                with open(server_file + ".bak", "w") as backup:
+                    backup.write(contents)
+                f.seek(0)
+                f.truncate()
+                json.dump({}, f)
+        guild_data["hashes"] = HashStore.from_dict(guild_data.get("hashes", {}))
+        guild_data["scanned_ranges"] = {channel_id: IntervalSet(ranges, merge_touching=True) for channel_id, ranges
+                                        in guild_data.get("scanned_ranges", {}).items()}
+        self.guilds[guild_name] = guild_data
+        return guild_data
+
+    def find_setting(self, k) -> dict:
+        """
+        Returns {guild name: value} for every stored guild that has the setting k. Reads every guild's file.
+        """
+        found = {}
+        for file_name in glob(path.join(self.directory, "*.json")):
+            guild_name = path.basename(file_name)[:-len(".json")]
+            guild_data = self.guilds.get(guild_name)
+            if guild_data is None:
+                try:
+                    with open(file_name) as f:
+                        guild_data = json.load(f)
+                except json.JSONDecodeError:
+                    continue
+            if k in guild_data:
+                found[guild_name] = guild_data[k]
+        return found
+
+    def unload_guild(self, guild_name):
+        self.guilds.pop(guild_name, None)
+
+    def save_snapshot(self, guild_name, hashes):
+        pass  # the JSON file is already the whole guild
+
+    def save_guild(self, guild_name):
+        with open(self.file_name(guild_name), "w") as f:
+            json.dump(self.guilds[guild_name], f, default=_to_json)
+
+    def set_value(self, guild_name, k, v):
+        self.save_guild(guild_name)
+
+    def del_value(self, guild_name, k):
+        self.save_guild(guild_name)
+
+    def add_postings(self, guild_name, hashes: dict):
+        self.save_guild(guild_name)
+
+    def set_scanned_ranges(self, guild_name, channel_id: int, ranges):
+        self.save_guild(guild_name)
+
+
+class SQLiteStorage:
+    """
+    Guild data in a single SQLite database in WAL mode. Settings, hashes, postings and scanned ranges are separate
+    tables, so each change only touches the rows it affects. Guilds that still have a JSON file from JSONStorage are
+    imported the first time they are loaded.
+    Image hashes are stored once in images, shared by all guilds, as raw bytes. Guilds only store which of them they
+    have (guild_hashes) and where they were posted (guild_postings), so matches never cross guilds.
+    Hashes and postings are also saved to a binary snapshot per guild (see HashStore.save) when a guild is unloaded,
+    which is mapped into memory on the next load instead of querying them. Every change to them increments the
+    guild's version in hashes_versions, from any process, and a snapshot is only used if it was saved at the
+    current version.
+    """
+
+    def __init__(self, db_file=DB_FILE, json_dir=DATA_DIR):
+        if path.dirname(db_file):
+            makedirs(path.dirname(db_file), exist_ok=True)
+        self.db_file = db_file
+        self.json_dir = json_dir
+        # several shard processes may write at once: transactions take the write lock when they begin, and wait up to
+        # 30s for it, instead of failing when a read has to be upgraded to a write
+        self.db = sqlite3.connect(
+            db_file, timeout=30, isolation_level="IMMEDIATE")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+        self.migrate_schema()
+        self.snapshots = set()  # guilds that may have a snapshot file
+        # guild -> the hashes version that the loaded guild matches, as long as only this process changed it
+        self.versions = {}
+
+    def snapshot_file(self, guild_name):
+        return path.join(path.dirname(self.db_file), "snapshots", guild_name + ".hashes")
+
+    def load_guild(self, guild_name) -> dict:
+        with self.db:
+            if self.db.execute("INSERT OR IGNORE INTO guilds (name) VALUES (?)", (guild_name,)).rowcount:
+                self.snapshots.add(guild_name)  # a leftover from a deleted database
+                self._invalidate_snapshot(guild_name)
+                self.migrate_json(guild_name)
+        guild_data = {"scanned_ranges": {}}
+        for k, v in self.db.execute("SELECT key, value FROM settings WHERE guild = ?", (guild_name,)):
+            guild_data[k] = json.loads(v)
+        guild_data["hashes"] = self.load_hashes(guild_name)
+        ranges = guild_data["scanned_ranges"]
+        for channel, start, end in self.db.execute(
+                "SELECT channel, start, end FROM scanned_ranges WHERE guild = ? ORDER BY channel, start",
+                (guild_name,)):
+            ranges.setdefault(str(channel), IntervalSet(merge_touching=True)).add(start, end)
+        return guild_data
+
+    def load_hashes(self, guild_name) -> HashStore:
+        # read before the hashes, so that a change in between makes the version look older rather than newer
+        version = self.versions[guild_name] = self._hashes_version(guild_name)
+        snapshot_file = self.snapshot_file(guild_name)
+        if path.isfile(snapshot_file):
+            self.snapshots.add(guild_name)
+            try:
+                hashes = HashStore.load(snapshot_file)
+                if hashes.version == version:
+                    return hashes
+                print(snapshot_file, "is out of date")
+            except (OSError, ValueError) as e:
+                print(e, "Could not load", snapshot_file)
+            self._invalidate_snapshot(guild_name)
+        return HashStore.from_postings(self.db.execute(
+            "SELECT lower(hex(hash)), channel, message FROM guild_hashes AS g JOIN images ON images.id = g.image_id "
+            "LEFT JOIN guild_postings AS p ON p.guild = g.guild AND p.image_id = g.image_id "
+            "WHERE g.guild = ? ORDER BY g.image_id", (guild_name,)))
+
+    def save_snapshot(self, guild_name, hashes):
+        """
+        Writes the guild's hashes to its snapshot file. hashes must match what is stored in the database.
+        """
+        if not isinstance(hashes, HashStore):
+            return
+        version = self.versions.get(guild_name)
+        if version is None:
+            return  # another process changed the hashes since they were loaded
+        self.snapshots.add(guild_name)
+        hashes.save(self.snapshot_file(guild_name), version)
+
+    def _hashes_version(self, guild_name):
+        row = self.db.execute("SELECT version FROM hashes_versions WHERE guild = ?", (guild_name,)).fetchone()
+        return row[0] if row else 0
+
+    def _hashes_changed(self, guild_name):
+        """
+        Increments the guild's hashes version and deletes its snapshot. Must be called inside a transaction that
+        changes the guild's hashes.
+        """
+        self._invalidate_snapshot(guild_name)
+        self.db.execute("INSERT INTO hashes_versions (guild, version) VALUES (?, 1) "
+                        "ON CONFLICT (guild) DO UPDATE SET version = version + 1", (guild_name,))
+        version = self._hashes_version(guild_name)
+        if self.versions.get(guild_name) == version - 1:
+            self.versions[guild_name] = version
+        else:
+            self.versions.pop(guild_name, None)
+
+    def _invalidate_snapshot(self, guild_name):
+        if guild_name in self.snapshots:
+            self.snapshots.discard(guild_name)
+            try:
+                remove(self.snapshot_file(guild_name))
+            except FileNotFoundError:
+                pass
+
+    def find_setting(self, k) -> dict:
+        """
+        Returns {guild name: value} for every stored guild that has the setting k.
+        """
+        return {guild_name: json.loads(v) for guild_name, v in
+                self.db.execute("SELECT guild, value FROM settings WHERE key = ?", (k,))}
+
+    def unload_guild(self, guild_name):
+        self.versions.pop(guild_name, None)
+
+    def migrate_schema(self):
+        """
+        Moves the hashes and postings of databases from before images was shared into the shared tables.
+        """
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")  # so that shards starting together migrate once
+            if not self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hashes'").fetchone():
+                return
+            hashes = self.db.execute("SELECT id, guild, hash FROM hashes").fetchall()
+            self.db.executemany("INSERT OR IGNORE INTO images (hash) VALUES (?)",
+                                [(bytes.fromhex(h),) for _, _, h in hashes])
+            image_ids = dict(self.db.execute("SELECT lower(hex(hash)), id FROM images"))
+            self.db.executemany("INSERT OR IGNORE INTO guild_hashes (guild, image_id) VALUES (?, ?)",
+                                [(guild_name, image_ids[h]) for _, guild_name, h in hashes])
+            hash_ids = {hash_id: (guild_name, image_ids[h]) for hash_id, guild_name, h in hashes}
+            self.db.executemany(
+                "INSERT OR IGNORE INTO guild_postings (guild, image_id, channel, message) VALUES (?, ?, ?, ?)",
+                [(*hash_ids[hash_id], channel, message) for hash_id, channel, message in
+                 self.db.execute("SELECT hash_id, channel, message FROM postings")])
+            self.db.execute("DROP TABLE postings")
+            self.db.execute("DROP TABLE hashes")
+            print("Moved", len(hashes), "guild hashes to", len(image_ids), "shared images in", self.db_file)
+
+    def migrate_json(self, guild_name):
+        """
+        Imports data/<guild_name>.json, then renames it so that it is not imported again.
+        Must be called inside a transaction.
+        """
+        json_file = path.join(self.json_dir, guild_name + ".json")
+        if not path.isfile(json_file):
+            return
+        try:
+            with open(json_file) as f:
+                guild_data = json.load(f) if path.getsize(json_file) else {}
+        except json.JSONDecodeError as e:
+            print(e, "Could not migrate", json_file)
+            return
+        for k, v in guild_data.items():
+            self._set_value(guild_name, k, v)
+        rename(json_file, json_file + ".migrated")
+        print("Migrated", json_file, "to", self.db_file)
+
+    def _set_value(self, guild_name, k, v):
+        if k == "hashes":
+            self.db.execute(
+                "DELETE FROM guild_hashes WHERE guild = ?", (guild_name,))
+            self._hashes_changed(guild_name)
+            self._add_postings(guild_name, v)
+        elif k == "scanned_ranges":
+            self.db.execute(
+                "DELETE FROM scanned_ranges WHERE guild = ?", (guild_name,))
+            for channel_id, ranges in v.items():
+                self._set_scanned_ranges(guild_name, int(channel_id), ranges)
+        else:
+            self.db.execute("INSERT OR REPLACE INTO settings (guild, key, value) VALUES (?, ?, ?)",
+                            (guild_name, k, json.dumps(v)))
+
+    def _add_postings(self, guild_name, hashes: dict):
+        self._hashes_changed(guild_name)
+        keys = {h: bytes.fromhex(h) for h in hashes}
+        self.db.executemany("INSERT OR IGNORE INTO images (hash) VALUES (?)",
+                            [(key,) for key in keys.values()])
+        self.db.executemany(
+            "INSERT OR IGNORE INTO guild_hashes (guild, image_id) SELECT ?, id FROM images WHERE hash = ?",
+            [(guild_name, key) for key in keys.values()])
+        self.db.executemany(
+            "INSERT OR IGNORE INTO guild_postings (guild, image_id, channel, message) "
+            "SELECT ?, id, ?, ? FROM images WHERE hash = ?",
+            [(guild_name, p[0], p[1], keys[h]) for h, posts in hashes.items() for p in posts])
+
+    def _set_scanned_ranges(self, guild_name, channel_id: int, ranges):
+        self.db.execute("DELETE FROM scanned_ranges WHERE guild = ? AND channel = ?",
+                        (guild_name, channel_id))
+        self.db.executemany("INSERT INTO scanned_ranges (guild, channel, start, end) VALUES (?, ?, ?, ?)",
+                            [(guild_name, channel_id, start, end) for start, end in ranges])
+
+    def set_value(self, guild_name, k, v):
+        with self.db:
+            self._set_value(guild_name, k, v)
+
+    def del_value(self, guild_name, k):
+        with self.db:
+            if k == "hashes":
+                self.db.execute(
+                    "DELETE FROM guild_hashes WHERE guild = ?", (guild_name,))
+                self._hashes_changed(guild_name)
+            elif k == "scanned_ranges":
+                self.db.execute(
+                    "DELETE FROM scanned_ranges WHERE guild = ?", (guild_name,))
+            else:
+                self.db.execute(
+                    "DELETE FROM settings WHERE guild = ? AND key = ?", (guild_name, k))
+
+    def add_postings(self, guild_name, hashes: dict):
+        """
+        Adds postings, given as a dict of hash strings to lists of (channel ID, message ID).
+        """
+        with self.db:
+            self._add_postings(guild_name, hashes)
+
+    def set_scanned_ranges(self, guild_name, channel_id: int, ranges):
+        with self.db:
+            self._set_scanned_ranges(guild_name, channel_id, ranges)
+
+
+def get_storage():
+    """
+    Returns the storage engine chosen by REPOSTI_STORAGE ("sqlite" or "json"), opening it on first use.
+    """
+    global _storage
+    if _storage is None:
+        if STORAGE == "json":
+            _storage = JSONStorage()
+        elif STORAGE == "sqlite":
+            _storage = SQLiteStorage()
+        else:
+            raise ValueError(f"Unknown storage engine '{STORAGE}'")
+    return _storage
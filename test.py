@@ -1,7 +1,33 @@
-from bot import num_in_ranges, add_range
+from bot import GuildSettings, jump_url
+from ranges import IntervalSet, split_ranges
+from hashindex import CascadeIndex, HashIndex, coarse_hash, hash_distance, pack
+from hashstore import HashStore
+from storage import SQLiteStorage
+from cache import LRU, HashCache
+from fetch import CircuitBreaker
+from indexer import message_images
+from scheduler import COMMAND, LIVE, SCAN, PriorityGate
+import asyncio
+import discord
+from datetime import datetime
+from hashing import decode_scale, DECODE_SCALE, HASH_SIZE
+import random
 import unittest
 
 
+def num_in_ranges(ranges, num):
+    return num in IntervalSet(ranges)
+
+
+def add_range(ranges, new_range):
+    """
+    The list interface that ranges used to have, run on an IntervalSet: the cases below are its compatibility spec.
+    """
+    s = IntervalSet(ranges)
+    s.add(*new_range)
+    ranges[:] = s.to_list()
+
+
 class TestNumInRanges(unittest.TestCase):
 
     def test_empty(self):
@@ -148,5 +174,726 @@ class TestAddRange(unittest.TestCase):
         self.assertSequenceEqual([[5, 10], [15, 20], [25, 30]], r)
 
 
+class TestGuildSettings(unittest.TestCase):
+
+    def test_included_channels(self):
+        self.assertEqual({1, 2, 3}, GuildSettings({"included_channels": [1, [2, 3], [], 1]}).included_channels)
+        self.assertEqual(frozenset(), GuildSettings({"included_channels": None}).included_channels)
+
+    def test_jump_url(self):
+        self.assertEqual("https://discord.com/channels/1/2/3", jump_url(1, 2, 3))
+
+
+class TestIntervalSet(unittest.TestCase):
+
+    def test_merge(self):
+        s = IntervalSet([[5, 10], [15, 20], [25, 30]])
+        s.add(16, 28)
+        self.assertSequenceEqual([[5, 10], [15, 30]], s.to_list())
+
+    def test_touching_ranges_stay_apart(self):
+        s = IntervalSet([[3, 12]])
+        s.add(13, 18)
+        self.assertSequenceEqual([[3, 12], [13, 18]], s.to_list())
+
+    def test_merge_touching(self):
+        s = IntervalSet([(5, 6), (0, 1), (8, 9)], merge_touching=True)
+        s.add(2, 4)
+        self.assertEqual([[0, 6], [8, 9]], s.to_list())
+
+    def test_reversed_range(self):
+        s = IntervalSet()
+        s.add(20, 10)
+        self.assertIn(15, s)
+        self.assertNotIn(21, s)
+
+    def test_gaps(self):
+        s = IntervalSet([[5, 10], [15, 20]])
+        self.assertEqual([[0, 4], [11, 14], [21, 30]], s.gaps(0, 30))
+        self.assertEqual([[11, 14]], s.gaps(7, 17))
+        self.assertEqual([], s.gaps(6, 9))
+
+    def test_split_ranges(self):
+        self.assertEqual([[0, 24], [25, 49], [50, 74], [75, 99]], split_ranges([[0, 99]], 4))
+        self.assertEqual([[0, 9], [20, 20], [30, 54], [55, 79], [80, 104], [105, 129]],
+                         split_ranges([[0, 9], [20, 20], [30, 129]], 4))
+        self.assertEqual([[0, 49], [50, 99], [200, 209]], split_ranges([[0, 99], [200, 209]], 16, min_size=50))
+
+    def test_matches_brute_force(self):
+        rng = random.Random(0)
+        numbers = set()
+        s = IntervalSet()
+        for _ in range(300):
+            start = rng.randrange(1000)
+            end = start + rng.randrange(20)
+            numbers.update(range(start, end + 1))
+            s.add(start, end)
+            for (_, end), (start, _) in zip(s, list(s)[1:]):
+                self.assertLess(end, start)  # sorted and disjoint
+        self.assertEqual(len(numbers), sum(end - start + 1 for start, end in s))
+        for num in range(1030):
+            self.assertEqual(num in numbers, num in s)
+
+
+class TestHashIndex(unittest.TestCase):
+
+    h = "0f" * 32
+
+    def flip(self, h, bits):
+        n = int(h, 16)
+        for b in bits:
+            n ^= 1 << b
+        return f"{n:064x}"
+
+    def test_empty(self):
+        self.assertEqual([], HashIndex().query(self.h, 20))
+
+    def test_exact(self):
+        self.assertEqual([(self.h, 0)], HashIndex([self.h]).query(self.h, 20))
+
+    def test_within_radius(self):
+        near = self.flip(self.h, range(0, 256, 14))  # 19 bits, spread over every chunk
+        self.assertEqual([(near, 19)], HashIndex([near]).query(self.h, 20))
+
+    def test_clustered_within_radius(self):
+        near = self.flip(self.h, range(19))  # 19 bits, all in the lowest chunks
+        self.assertEqual([(near, 19)], HashIndex([near]).query(self.h, 20))
+
+    def test_at_radius(self):
+        far = self.flip(self.h, range(0, 256, 12))  # 22 bits
+        self.assertEqual([], HashIndex([far]).query(self.h, 20))
+
+    def test_closest_first(self):
+        near = self.flip(self.h, [3])
+        nearer = self.flip(self.h, [])
+        index = HashIndex([near, nearer])
+        self.assertEqual([(nearer, 0), (near, 1)], index.query(self.h, 20))
+
+    def test_duplicate_add(self):
+        index = HashIndex([self.h, self.h])
+        self.assertEqual(1, len(index))
+
+    def test_query_many(self):
+        near = self.flip(self.h, [200])
+        other = "f0" * 32
+        index = HashIndex([near, other])
+        self.assertEqual([[(near, 1)], [(other, 0)], []],
+                         index.query_many([self.h, other, "ff" * 32], 20))
+
+    def test_distances(self):
+        index = HashIndex([self.h, "f0" * 32])
+        self.assertEqual([[0, 256], [8, 248]], index.distances(
+            [self.h, self.flip(self.h, range(0, 256, 32))]).tolist())
+
+
+class TestCascadeIndex(unittest.TestCase):
+
+    h = TestHashIndex.h
+    flip = TestHashIndex.flip
+
+    def test_coarse_hash_majority(self):
+        # the top left 2x2 block of the 16x16 grid is bits 0, 1, 16 and 17, counted from the most significant
+        two = self.flip("00" * 32, [255, 254])
+        one = self.flip("00" * 32, [255])
+        self.assertEqual(["80" + "00" * 7, "00" * 8],
+                         [c.tobytes().hex() for c in coarse_hash(pack([two, one]))])
+
+    def test_same_matches_as_full_index(self):
+        near = self.flip(self.h, [0, 100, 200])
+        far = self.flip(self.h, range(0, 256, 8))
+        hashes = [near, far, "f0" * 32]
+        cascade = CascadeIndex(hashes, prefilter_diff=7)
+        self.assertEqual(HashIndex(hashes).query_many([self.h, far], 20),
+                         cascade.query_many([self.h, far], 20))
+
+    def test_prefilter_drops_distant(self):
+        zero = "00" * 32
+        spread = self.flip(zero, range(240, 256))  # 16 bits, setting 8 coarse bits
+        self.assertEqual([(spread, 16)], HashIndex([spread]).query(zero, 20))
+        self.assertEqual([], CascadeIndex([spread], prefilter_diff=7).query(zero, 20))
+
+
+class TestHashDistance(unittest.TestCase):
+
+    def test_equal(self):
+        self.assertEqual(0, hash_distance("8f" * 32, "8f" * 32))
+
+    def test_whash_width(self):
+        self.assertEqual(256, hash_distance("00" * 32, "ff" * 32))
+
+    def test_short(self):
+        self.assertEqual(4, hash_distance("ff00", "0f00"))
+
+
+class TestHashStore(unittest.TestCase):
+
+    def setUp(self):
+        self.hashes = {"01" * 32: [[1, 10], [2, 20]], "02" * 32: [], "03" * 32: [[1, 30]]}
+
+    def test_reads_like_dict(self):
+        store = HashStore.from_dict(self.hashes)
+        self.assertEqual(self.hashes, dict(store.items()))
+        self.assertIn("02" * 32, store)
+        self.assertNotIn("04" * 32, store)
+        self.assertIsNone(store.get("not hex"))
+
+    def test_add_skips_duplicates(self):
+        store = HashStore.from_dict(self.hashes)
+        self.assertFalse(store.add("01" * 32, 2, 20))
+        self.assertTrue(store.add("01" * 32, 3, 40))
+        self.assertTrue(store.add("04" * 32, 1, 50))
+        self.assertEqual([[1, 10], [2, 20], [3, 40]], store["01" * 32])
+        self.assertEqual(4, len(store))
+
+    def test_snapshot_round_trip(self):
+        import tempfile
+        from os import path
+        store = HashStore.from_dict(self.hashes)
+        store.add("02" * 32, 5, 5)
+        store.add("05" * 32, 6, 6)
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = path.join(directory, "guild.hashes")
+            store.save(file_name)
+            loaded = HashStore.load(file_name)
+            self.assertEqual(dict(store.items()), dict(loaded.items()))
+            self.assertTrue(loaded.add("05" * 32, 7, 7))
+            self.assertEqual([[6, 6], [7, 7]], loaded["05" * 32])
+
+
+class TestSQLiteStorage(unittest.TestCase):
+
+    def test_migrates_json(self):
+        import json
+        import tempfile
+        from os import path
+        guild_data = {"enabled": True, "included_channels": [[10, 11], [12]],
+                      "hashes": {"01" * 32: [[10, 100], [11, 101]], "02" * 32: []},
+                      "scanned_ranges": {"10": [[90, 100], [200, 300]]}}
+        with tempfile.TemporaryDirectory() as directory:
+            json_file = path.join(directory, "Guild_1.json")
+            with open(json_file, "w") as f:
+                json.dump(guild_data, f)
+            storage = SQLiteStorage(path.join(directory, "reposti.sqlite3"), directory)
+            loaded = storage.load_guild("Guild_1")
+            self.assertEqual(True, loaded["enabled"])
+            self.assertEqual(frozenset({10, 11, 12}), GuildSettings(loaded).included_channels)
+            self.assertEqual(guild_data["hashes"], dict(loaded["hashes"].items()))
+            self.assertEqual({"10": IntervalSet([(90, 100), (200, 300)])}, loaded["scanned_ranges"])
+            self.assertFalse(path.exists(json_file))
+            self.assertTrue(path.isfile(json_file + ".migrated"))
+            # imported once: the renamed file is not read again
+            storage.set_value("Guild_1", "enabled", False)
+            reopened = SQLiteStorage(storage.db_file, directory)
+            self.assertEqual(False, reopened.load_guild("Guild_1")["enabled"])
+            reopened.db.close()
+            storage.db.close()
+
+    def test_snapshot_changed_by_another_process(self):
+        import tempfile
+        from os import path
+        with tempfile.TemporaryDirectory() as directory:
+            db_file = path.join(directory, "reposti.sqlite3")
+            storage = SQLiteStorage(db_file, directory)
+            other = SQLiteStorage(db_file, directory)
+            storage.add_postings("a", {"01" * 32: [(1, 10)], "02" * 32: [(1, 11)]})
+            hashes = storage.load_guild("a")["hashes"]
+            storage.save_snapshot("a", hashes)
+            other.add_postings("a", {"03" * 32: [(1, 12)]})
+            self.assertEqual(3, len(storage.load_hashes("a")))
+            # a guild loaded before another process changed it is not snapshotted with the change missing
+            storage.add_postings("a", {"04" * 32: [(1, 13)]})
+            hashes.add("04" * 32, 1, 13)
+            other.add_postings("a", {"05" * 32: [(1, 14)]})
+            storage.save_snapshot("a", hashes)
+            self.assertEqual(5, len(other.load_hashes("a")))
+            storage.db.close()
+            other.db.close()
+
+    def test_images_shared_postings_not(self):
+        import tempfile
+        from os import path
+        with tempfile.TemporaryDirectory() as directory:
+            storage = SQLiteStorage(path.join(directory, "reposti.sqlite3"), directory)
+            storage.add_postings("a", {"01" * 32: [(1, 10)], "02" * 32: [(1, 11)]})
+            storage.add_postings("b", {"01" * 32: [(2, 20)]})
+            self.assertEqual(2, storage.db.execute("SELECT count(*) FROM images").fetchone()[0])
+            self.assertEqual({"01" * 32: [[2, 20]]}, dict(storage.load_hashes("b").items()))
+            storage.del_value("a", "hashes")
+            self.assertEqual({}, dict(storage.load_hashes("a").items()))
+            self.assertEqual({"01" * 32: [[2, 20]]}, dict(storage.load_hashes("b").items()))
+            storage.db.close()
+
+
+def use_temporary_storage(test):
+    """
+    Points get_storage() at a new SQLite database for the duration of a test. Returns the storage.
+    """
+    import bot
+    import storage
+    import tempfile
+    from os import path
+    from unittest import mock
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    engine = storage.SQLiteStorage(path.join(directory.name, "reposti.sqlite3"), directory.name)
+    test.addCleanup(engine.db.close)
+    for patch in (mock.patch.object(storage, "_storage", engine), mock.patch.dict(bot.hash_indexes)):
+        patch.start()
+        test.addCleanup(patch.stop)
+    return engine
+
+
+class TestScan(unittest.TestCase):
+    """
+    Scans of a bench.FakeChannel, with image_hash_from_message replaced by one hash per message.
+    """
+
+    def setUp(self):
+        import bot
+        from bench import SNOWFLAKE_START, FakeChannel, FakeGuild, FakeObject
+        from unittest import mock
+        self.storage = use_temporary_storage(self)
+        for patch in (mock.patch.object(bot, "image_hash_from_message", self.hash_message),
+                      mock.patch.object(bot, "channel_slots", None), mock.patch.object(bot, "message_slots", None)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.bot = bot
+        self.guild = FakeGuild("Scan", 1)
+        self.channel = FakeChannel(self.guild, SNOWFLAKE_START, "scan")
+        self.channel.messages = [FakeObject(id=SNOWFLAKE_START + 1000 * (i + 1), jump_url="")
+                                 for i in range(100)]
+        self.guild_name, _ = bot.unique_guild_data(self.guild)
+        self.data = {self.guild_name: self.storage.load_guild(self.guild_name)}
+        self.hashed = []
+        self.block_after = None  # messages hashed before the rest hang until cancelled
+        self.error = None
+        self.transient = set()  # messages whose images fail for now
+
+    async def hash_message(self, m):
+        if self.error is not None:
+            raise self.error
+        if self.block_after is not None and len(self.hashed) >= self.block_after:
+            await asyncio.Event().wait()
+        self.hashed.append(m.id)
+        if m.id in self.transient:
+            return {"hashes": [], "errors": 1, "transient": 1, "unhashables": 0}
+        return {"hashes": [f"{m.id:064x}"], "errors": 0, "transient": 0, "unhashables": 0}
+
+    def scan(self, history_args, **kwargs):
+        return asyncio.run(asyncio.wait_for(self.bot.scan_channel(self.channel, self.data, history_args, **kwargs),
+                                            10))
+
+    def interrupt(self, history_args, after):
+        """
+        Runs a scan until `after` messages are hashed, then stops it the way shutting down does. Returns the record
+        it left to resume from.
+        """
+        async def run():
+            self.block_after = after
+            task = asyncio.ensure_future(self.bot.scan_channel(self.channel, self.data, history_args))
+            while len(self.hashed) < after:
+                await asyncio.sleep(0.001)
+            await asyncio.sleep(0.01)  # let the other workers block too
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(asyncio.wait_for(run(), 10))
+        self.block_after = None
+        return self.data[self.guild_name]["scans"][str(self.channel.id)]
+
+    def assert_scanned(self, message_ids):
+        expected = {f"{i:064x}": [[self.channel.id, i]] for i in message_ids}
+        self.assertEqual(expected, dict(self.data[self.guild_name]["hashes"].items()))
+        self.assertEqual(expected, dict(self.storage.load_hashes(self.guild_name).items()))
+        ranges = self.data[self.guild_name]["scanned_ranges"][str(self.channel.id)]
+        for (_, end), (start, _) in zip(ranges, list(ranges)[1:]):
+            self.assertEqual(end + 1, start)  # no gaps between the ranges
+        self.assertTrue(all(i in ranges for i in message_ids))
+        self.assertFalse(self.data[self.guild_name].get("scans"))  # the scan record is gone once it is done
+
+    def test_resume_limited_scan(self):
+        record = self.interrupt({"limit": 60}, 20)
+        self.assertLess(record["limit"], 60)
+        history_args, kwargs = self.bot.resume_scan_args(record)
+        self.scan(history_args, **kwargs)
+        message_ids = [m.id for m in self.channel.messages[-60:]]
+        self.assert_scanned(message_ids)
+        self.assertNotIn(self.channel.messages[-61].id,
+                         self.data[self.guild_name]["scanned_ranges"][str(self.channel.id)])
+
+    def spread_messages(self):
+        """
+        Spreads the messages over the channel's lifetime, so that a whole channel scan reads them in every segment.
+        """
+        now = discord.utils.time_snowflake(datetime.utcnow())
+        step = (now - self.channel.id) // (len(self.channel.messages) + 1)
+        for i, m in enumerate(self.channel.messages):
+            m.id = self.channel.id + step * (i + 1)
+
+    def count_history_calls(self):
+        history = self.channel.history
+        calls = []
+
+        def counted(**kwargs):
+            calls.append(kwargs)
+            return history(**kwargs)
+        self.channel.history = counted
+        return calls
+
+    def test_resume_segmented_scan(self):
+        self.spread_messages()
+        record = self.interrupt({"limit": None}, 30)
+        self.assertIn("segments", record)
+        history_args, kwargs = self.bot.resume_scan_args(record)
+        self.scan(history_args, **kwargs)
+        self.assert_scanned([m.id for m in self.channel.messages])
+        self.assertEqual(1, len(self.data[self.guild_name]["scanned_ranges"][str(self.channel.id)]))
+
+    def test_rescan_reads_only_new_messages(self):
+        self.spread_messages()
+        self.scan({"limit": None})
+        calls = self.count_history_calls()
+        self.assertEqual((0, 0, 0, 0), self.scan({"limit": None}))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, len(self.data[self.guild_name]["scanned_ranges"][str(self.channel.id)]))
+
+    def test_transient_failure_not_scanned(self):
+        failed = self.channel.messages[40].id
+        self.transient.add(failed)
+        self.scan({"limit": None})
+        ranges = self.data[self.guild_name]["scanned_ranges"][str(self.channel.id)]
+        self.assertNotIn(failed, ranges)
+        self.assertIn(self.channel.messages[39].id, ranges)
+        self.transient.clear()
+        self.scan({"limit": None})
+        self.assert_scanned([m.id for m in self.channel.messages])
+
+    def test_worker_failure_ends_scan(self):
+        import sqlite3
+        self.error = sqlite3.OperationalError("database is locked")
+        with self.assertRaises(sqlite3.OperationalError):
+            self.scan({"limit": None})
+        self.assertNotIn(self.channel.id, self.bot.active_scans)
+
+
+class TestHashCache(unittest.TestCase):
+
+    def test_lru_evicts_oldest(self):
+        lru = LRU(2)
+        lru.put("a", 1)
+        lru.put("b", 2)
+        lru.get("a")
+        lru.put("c", 3)
+        self.assertEqual((1, None, 3), (lru.get("a"), lru.get("b"), lru.get("c")))
+
+    def test_digest_hit_for_new_key(self):
+        cache = HashCache(db_file="")
+        cache.put("attachment:1", b"digest", "ab")
+        self.assertIsNone(cache.get_key("attachment:2"))
+        self.assertEqual("ab", cache.get_digest(b"digest"))
+
+    def test_failure_expires(self):
+        cache = HashCache(db_file="")
+        cache.put_failure("attachment:1", "404", "refused", 60)
+        cache.put_failure("attachment:2", "timeout", "transient", -1)
+        self.assertEqual(("404", "refused"), cache.get_failure("attachment:1"))
+        self.assertIsNone(cache.get_failure("attachment:2"))
+        self.assertIsNone(cache.get_failure("attachment:3"))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_summary_counters_before_histograms(self):
+        import metrics
+        metrics.observe("test_summary_seconds", 0.01)
+        metrics.inc("test_summary_total")
+        lines = metrics.summary().split("\n")
+        index = {line.split(":")[0]: i for i, line in enumerate(lines)}
+        self.assertLess(index["test_summary_total"], index["test_summary_seconds"])
+
+
+class TestRetryDelay(unittest.TestCase):
+
+    def test_retry_after(self):
+        import fetch
+        from types import SimpleNamespace
+
+        def response(retry_after):
+            return SimpleNamespace(headers={"Retry-After": retry_after})
+        self.assertEqual(2, fetch.retry_delay(0, response("2")))
+        self.assertIsNone(fetch.retry_delay(0, response(str(fetch.MAX_RETRY_DELAY + 1))))
+        self.assertEqual(fetch.RETRY_BACKOFF, fetch.retry_delay(0, response("soon")))
+        self.assertEqual(fetch.MAX_RETRY_DELAY, fetch.retry_delay(100))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_after_failures_in_a_row(self):
+        breaker = CircuitBreaker(failures=2, cooldown=60)
+        breaker.failure("cdn")
+        breaker.success("cdn")
+        breaker.failure("cdn")
+        self.assertTrue(breaker.allow("cdn"))
+        breaker.failure("cdn")
+        self.assertFalse(breaker.allow("cdn"))
+        self.assertTrue(breaker.allow("other"))
+
+    def test_single_probe_after_cooldown(self):
+        breaker = CircuitBreaker(failures=1, cooldown=0)
+        breaker.failure("cdn")
+        self.assertTrue(breaker.allow("cdn"))
+        self.assertFalse(breaker.allow("cdn"))
+        breaker.success("cdn")
+        breaker.failure("cdn")
+        self.assertTrue(breaker.allow("cdn", probe=False))  # the probe is still free
+        self.assertTrue(breaker.allow("cdn"))
+        breaker.success("cdn")
+        self.assertTrue(breaker.allow("cdn"))
+        self.assertTrue(breaker.allow("cdn"))
+
+    def test_idle_hosts_forgotten(self):
+        import fetch
+        from types import SimpleNamespace
+        from unittest import mock
+        clock = SimpleNamespace(monotonic=lambda: now)
+        now = 0
+        with mock.patch.object(fetch, "time", clock):
+            breaker = CircuitBreaker(failures=2, cooldown=10)
+            breaker.failure("open")
+            breaker.failure("open")
+            breaker.failure("failed")
+            self.assertEqual(1, breaker.open_count())
+            now = 11
+            self.assertEqual(0, breaker.open_count())
+            self.assertTrue(breaker.allow("open", probe=False))
+            now = 25
+            breaker.failure("other")
+        self.assertEqual(({"other": 1}, {}), (breaker.failed, breaker.open_until))
+
+
+class TestPriorityGate(unittest.TestCase):
+
+    def test_live_before_scan(self):
+        async def run():
+            gate = PriorityGate("test", 1, reserved=0)
+            order = []
+
+            async def job(priority, name):
+                await gate.acquire(priority)
+                order.append(name)
+                gate.release()
+            await gate.acquire(SCAN)
+            tasks = [asyncio.ensure_future(job(p, n))
+                     for p, n in ((SCAN, "scan"), (COMMAND, "command"), (LIVE, "live"))]
+            await asyncio.sleep(0)
+            gate.release()
+            await asyncio.gather(*tasks)
+            return order
+        self.assertEqual(["live", "command", "scan"], asyncio.run(run()))
+
+    def test_scans_leave_reserved_slots(self):
+        async def run():
+            gate = PriorityGate("test", 2, reserved=1)
+            await gate.acquire(SCAN)
+            waiting = asyncio.ensure_future(gate.acquire(SCAN))
+            await asyncio.sleep(0)
+            await asyncio.wait_for(gate.acquire(LIVE), 1)
+            blocked = not waiting.done()
+            waiting.cancel()
+            return blocked, gate.in_use
+        self.assertEqual((True, 2), asyncio.run(run()))
+
+    def test_download_slots_per_host(self):
+        import fetch
+        from unittest import mock
+
+        async def hold(host, release):
+            async with fetch.download_slot(host):
+                await release.wait()
+
+        async def run():
+            release = asyncio.Event()
+            holders = [asyncio.ensure_future(hold(host, release))
+                       for host in ("cdn.example.com", "i.example.com", "cdn.example.com")]
+            await asyncio.sleep(0)
+            used = {host: (gate.in_use, len(gate.waiters[LIVE])) for host, gate in fetch._gates.items()}
+            release.set()
+            await asyncio.gather(*holders)
+            return used, set(fetch._gates)
+
+        with mock.patch.object(fetch, "MAX_CONNECTIONS_PER_HOST", 1), mock.patch.dict(fetch._gates, clear=True):
+            used, left = asyncio.run(run())
+        self.assertEqual({"cdn.example.com": (1, 1), "i.example.com": (1, 0)}, used)
+        self.assertEqual(set(), left)
+
+    def test_idle_download_gate_dropped_after_error(self):
+        import fetch
+        import metrics
+        from unittest import mock
+
+        async def run():
+            with self.assertRaises(ValueError):
+                async with fetch.download_slot("cdn.example.com"):
+                    raise ValueError
+
+        with mock.patch.dict(fetch._gates, clear=True):
+            asyncio.run(run())
+            self.assertEqual({}, fetch._gates)
+        self.assertNotIn("cdn.example.com", metrics.summary())
+
+    def test_cancelled_waiter_already_dropped(self):
+        async def run():
+            gate = PriorityGate("test", 1, reserved=0)
+            await gate.acquire(LIVE)
+            waiting = asyncio.ensure_future(gate.acquire(LIVE))
+            await asyncio.sleep(0)
+            waiting.cancel()
+            gate.release()  # drops the cancelled waiter before its task runs
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+            return gate.in_use, len(gate.waiters[LIVE])
+        self.assertEqual((0, 0), asyncio.run(run()))
+
+
+class TestGuildData(unittest.TestCase):
+    """
+    Lazy loading and eviction of guilds, with a cache that fits two of the test guilds.
+    """
+
+    def setUp(self):
+        import bot
+        from bench import FakeGuild
+        from unittest import mock
+        self.storage = use_temporary_storage(self)
+        self.bot = bot
+        self.guilds = [FakeGuild(f"Guild{i}", i) for i in range(3)]
+        self.names = [bot.unique_guild_data(guild)[0] for guild in self.guilds]
+        self.data = bot.GuildData()
+        self.add_hashes(self.guilds[0], 10)
+        size = bot.guild_size(self.data[self.names[0]])
+        for patch in (mock.patch.object(bot, "GUILD_CACHE_BYTES", size * 5 // 2),
+                      mock.patch.object(bot, "EVICT_SECONDS", 0)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def add_hashes(self, guild, n, start=0):
+        self.bot.add_hash_data(self.data, guild, {f"{guild.id:02x}{i:062x}": [[guild.id, i]]
+                                                  for i in range(start, start + n)})
+
+    def loaded(self):
+        return set(dict.keys(self.data))
+
+    def test_lazy_load(self):
+        self.add_hashes(self.guilds[1], 10)
+        data = self.bot.GuildData()
+        self.assertEqual(set(), set(dict.keys(data)))
+        self.assertEqual(10, len(data[self.names[1]]["hashes"]))
+        self.assertEqual({self.names[1]}, set(dict.keys(data)))
+
+    def test_evicts_least_recently_used(self):
+        self.add_hashes(self.guilds[1], 10)
+        self.data[self.names[0]]
+        self.add_hashes(self.guilds[2], 10)
+        self.assertEqual({self.names[0], self.names[2]}, self.loaded())
+
+    def test_keeps_scanning_guild(self):
+        from bench import FakeChannel
+        from types import SimpleNamespace
+        from unittest import mock
+        self.add_hashes(self.guilds[1], 10)
+        scan = SimpleNamespace(channel=FakeChannel(self.guilds[0], 1, "scan"))
+        with mock.patch.dict(self.bot.active_scans, {1: scan}):
+            self.add_hashes(self.guilds[2], 10)
+        self.assertEqual({self.names[0], self.names[2]}, self.loaded())
+
+    def test_evicts_when_guild_grows(self):
+        self.add_hashes(self.guilds[1], 10)
+        self.assertEqual({self.names[0], self.names[1]}, self.loaded())
+        self.add_hashes(self.guilds[1], 10, start=10)
+        self.assertEqual({self.names[1]}, self.loaded())
+
+    def test_reload_from_snapshot(self):
+        from hashstore import HashStore
+        from os import path
+        from unittest import mock
+        expected = dict(self.data[self.names[0]]["hashes"].items())
+        self.add_hashes(self.guilds[1], 10)
+        self.add_hashes(self.guilds[2], 10)
+        self.assertNotIn(self.names[0], self.loaded())
+        self.assertTrue(path.isfile(self.storage.snapshot_file(self.names[0])))
+        with mock.patch.object(HashStore, "load", side_effect=HashStore.load) as load:
+            self.assertEqual(expected, dict(self.data[self.names[0]]["hashes"].items()))
+        load.assert_called_once()
+
+
+class TestIndexer(unittest.TestCase):
+
+    def test_message_images(self):
+        message = {"embeds": [{"thumbnail": {"url": "https://example.com/a.png"}, "image": {"url": "b.png"}},
+                              {"image": {"url": "c.json_Files/c.png"}}, {"title": "no image"}],
+                   "attachments": [{"id": "1", "url": "c.json_Files/d.JPG", "fileName": "d.JPG"},
+                                   {"id": "2", "url": "c.json_Files/e.mp4", "fileName": "e.mp4"}]}
+        self.assertEqual([("https://example.com/a.png", "https://example.com/a.png"), (None, "c.json_Files/c.png"),
+                          ("attachment:1", "c.json_Files/d.JPG")], message_images(message))
+
+    def test_linked_images_not_marked_scanned(self):
+        import bot
+        import indexer
+        import json
+        import tempfile
+        from os import path
+        from types import SimpleNamespace
+        from unittest import mock
+        storage = use_temporary_storage(self)
+        messages = [{"id": str(i), "attachments": [], "embeds": []} for i in range(1, 7)]
+        messages[2]["attachments"].append({"id": "30", "url": "https://cdn.example.com/a.png", "fileName": "a.png"})
+        guild_name, _ = bot.unique_guild_data(SimpleNamespace(name="Guild", id=5))
+        data = {guild_name: storage.load_guild(guild_name)}
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(indexer, "BATCH_MESSAGES", 2):
+            export_file = path.join(directory, "export.json")
+            with open(export_file, "w") as f:
+                json.dump({"guild": {"id": "5", "name": "Guild"}, "channel": {"id": "7", "name": "general"},
+                           "messages": messages}, f)
+            counts = asyncio.run(indexer.index_export(data, export_file, SimpleNamespace(force=False, download=False)))
+        self.assertEqual((6, 0, 0, 1, 0), counts)
+        self.assertEqual(IntervalSet([(1, 2), (4, 6)]), data[guild_name]["scanned_ranges"]["7"])
+
+    def test_missing_files_not_marked_scanned(self):
+        import bot
+        import cache
+        import indexer
+        import json
+        import tempfile
+        from os import path
+        from types import SimpleNamespace
+        from unittest import mock
+        storage = use_temporary_storage(self)
+        messages = [{"id": str(i), "attachments": [], "embeds": []} for i in range(1, 5)]
+        messages[1]["attachments"].append({"id": "20", "url": "export.json_Files/a.png", "fileName": "a.png"})
+        guild_name, _ = bot.unique_guild_data(SimpleNamespace(name="Guild", id=5))
+        data = {guild_name: storage.load_guild(guild_name)}
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(cache, "_cache", HashCache(db_file="")):
+            export_file = path.join(directory, "export.json")
+            with open(export_file, "w") as f:
+                json.dump({"guild": {"id": "5", "name": "Guild"}, "channel": {"id": "7", "name": "general"},
+                           "messages": messages}, f)
+            counts = asyncio.run(indexer.index_export(data, export_file, SimpleNamespace(force=False, download=False)))
+            self.assertIsNone(cache._cache.get_failure("attachment:20"))
+        self.assertEqual((4, 0, 0, 0, 1), counts)
+        self.assertEqual(IntervalSet([(1, 1), (3, 4)]), data[guild_name]["scanned_ranges"]["7"])
+
+
+class TestDecodeScale(unittest.TestCase):
+
+    def test_power_of_two_below_size(self):
+        self.assertEqual(128, decode_scale((200, 130)))
+
+    def test_capped(self):
+        self.assertEqual(DECODE_SCALE, decode_scale((4000, 3000)))
+
+    def test_tiny(self):
+        self.assertEqual(HASH_SIZE, decode_scale((3, 1)))
+
+
 if __name__ == '__main__':
     unittest.main()